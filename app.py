@@ -8,27 +8,193 @@ folder = os.path.dirname(os.path.abspath(__file__))  # noqa
 sys.path.insert(0, os.path.normpath("%s/.." % folder))  # noqa
 from pytradfri import Gateway
 from pytradfri.api.libcoap_api import APIFactory
-from pytradfri.error import PytradfriError
-from pytradfri.util import load_json, save_json
-from pytradfri.const import ATTR_ID, ATTR_NAME, ATTR_DEVICE_STATE, ATTR_LIGHT_DIMMER, ATTR_LIGHT_MIREDS
+from pytradfri.api.pooled_api import APIFactory as PooledAPIFactory
+from pytradfri.api.coalesce import CommandCoalescer
+from pytradfri.api.scheduler import CommandScheduler, PRIORITY_BULK, PRIORITY_OBSERVE
+from pytradfri.discovery import DiscoveryResult, discover
+from pytradfri.effects import EffectEngine, chase, fade, sunrise
+from pytradfri.error import CircuitOpenError, PytradfriError
+from pytradfri.group import Group
+from pytradfri.registry import Registry
+from pytradfri.snapshot import load_snapshot, save_snapshot
+from pytradfri.supervisor import ObservationSupervisor
+from pytradfri.util import dumps, load_json, save_json
+from pytradfri.const import ATTR_NAME, ATTR_DEVICE_STATE, ATTR_LIGHT_DIMMER, ATTR_LIGHT_MIREDS, ATTR_LIGHT_CONTROL, ROOT_DEVICES
 
 # -- Imports added here
-from flask import Flask, abort
+from flask import Flask, Response, abort, request
 from flasgger import Swagger
-import jsonpickle as jp
 import traceback
+import argparse
+import threading
+import queue
+import asyncio
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import time
+import json
+from urllib.parse import parse_qs
+from werkzeug.exceptions import HTTPException, default_exceptions
+try:
+    import uvicorn
+    from uvicorn.middleware.wsgi import WSGIMiddleware
+except ImportError:
+    uvicorn = None # only needed for '--server asgi'
 
 app = Flask(__name__)
 swagger = Swagger(app)
 
 # Global scope variables serving as in-memory db of lights and groups
 # (ugly but simple solution)
-api_factory = None
-api = None
-gateway = None
-devices = None
-lights = None
-groups = None
+gateways = [] # one GatewayConnection per gateway in the config file
+response_cache = {} # encoded GET responses by ETag, re-encoded only when a light/group has been updated
+server_id = format(int(time.time()), "x") # part of ETags, since versions restart from 0 when the server restarts
+
+OBSERVE_DURATION = 600 # seconds, observations are renewed shortly before they expire
+BATCH_MAX_WORKERS = 16 # max number of batch operations sent to the gateway at once
+EVENTS_QUEUE_SIZE = 100 # max number of events queued for a slow event stream client before it has to resync
+EVENTS_KEEPALIVE = 15 # seconds
+SNAPSHOT_INTERVAL = 300 # seconds between saving the state of changed gateways to their snapshot files
+EFFECTS_RATE_SHARE = 0.5 # share of '--rate' running effects may use, so the lights stay responsive to other commands
+EFFECTS = ("sunrise", "fade", "chase", "stop")
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS)
+event_streams = set()
+event_streams_lock = threading.Lock()
+last_published = {} # last published state per light/group, so only changed fields are pushed
+effects_loop = asyncio.new_event_loop() # runs the effects of all gateways, see run_group_effect
+
+# Everything needed for talking to one gateway: its API, command queues and in-memory db of lights and groups
+class GatewayConnection:
+    def __init__(self, host, identity, psk, args):
+        self.host = host
+        self.gateway = Gateway()
+        self.registry = Registry()
+        if args.backend == "aiocoap":
+            self.api_factory = PooledAPIFactory(host, identity, psk, pool_size=args.pool_size)
+        else:
+            self.api_factory = APIFactory(host, identity, psk)
+        self.scheduler = CommandScheduler(self.api_factory.request, max_in_flight=args.max_in_flight, rate=args.rate)
+        self.api = self.scheduler.request
+        self.discovery_workers = args.discovery_workers
+        self.supervisor = ObservationSupervisor(lambda command: self.api(command, priority=PRIORITY_OBSERVE), duration=OBSERVE_DURATION)
+        self.snapshot_file = None
+        if args.snapshot_dir:
+            os.makedirs(args.snapshot_dir, exist_ok=True)
+            self.snapshot_file = os.path.join(args.snapshot_dir, "snapshot-{}.json".format(host))
+        self.snapshot_versions = None # registry versions when the snapshot was last saved
+        self.effects = EffectEngine(self.schedule, rate=args.rate * EFFECTS_RATE_SHARE)
+        self.coalescer = None
+        if args.flush_interval > 0:
+            self.coalescer = CommandCoalescer(self.submit, flush_interval=args.flush_interval)
+
+    # Fetches everything on the gateway in parallel; resources that fail to load keep their last known state
+    # and the snapshot is only saved from a complete discovery, so a gateway that is down doesn't wipe it
+    def refresh(self):
+        result = discover(lambda command: self.api(command, priority=PRIORITY_BULK), self.gateway,
+            max_workers=self.discovery_workers, progress=self.log_progress)
+        if not result.complete:
+            app.logger.warning("Discovery of %s incomplete, failed: %s", self.host, ", ".join(sorted(result.errors)))
+            result.keep_failed(self.known_resources())
+        self.load(result)
+        if result.complete: self.save_snapshot()
+
+    # Loads the last known state from the snapshot file, returns False if there is none
+    def restore(self):
+        if self.snapshot_file is None: return False
+        result = load_snapshot(self.snapshot_file, self.host, self.gateway)
+        if result is None: return False
+        self.load(result)
+        app.logger.warning("Restored %d devices and %d groups of %s from %s",
+            len(result.devices), len(result.groups), self.host, self.snapshot_file)
+        return True
+
+    def known_resources(self):
+        known = DiscoveryResult()
+        known.devices = self.registry.devices
+        known.groups = self.registry.groups
+        known.moods = {group.id: self.registry.moods_of(group.id) for group in known.groups}
+        known.smart_tasks = self.registry.smart_tasks
+        return known
+
+    def load(self, result):
+        for device in result.devices:
+            self.api_factory.breakers.update_device(device)
+        self.registry.set_devices(result.devices)
+        self.registry.set_groups(result.groups)
+        self.registry.set_moods(result.moods)
+        self.registry.set_smart_tasks(result.smart_tasks)
+
+    def save_snapshot(self):
+        if self.snapshot_file is None: return
+        versions = (self.registry.devices_version, self.registry.groups_version)
+        if versions == self.snapshot_versions: return
+        try:
+            save_snapshot(self.snapshot_file, self.host, self.registry)
+            self.snapshot_versions = versions
+        except PytradfriError:
+            app.logger.error("Failed to save snapshot of %s", self.host)
+
+    def log_resources(self):
+        app.logger.warning("-- LIGHTS (%s) --", self.host)
+        app.logger.warning(self.registry.lights)
+        app.logger.warning("-- GROUPS (%s) --", self.host)
+        app.logger.warning(self.registry.groups)
+
+    def log_progress(self, kind, done, total):
+        if done == total or done % 25 == 0:
+            app.logger.warning("Discovering %s %s: %d/%d", self.host, kind, done, total)
+
+    # Sends a command through the write-combining queue (if enabled) so rapid updates of the same light/group are merged
+    def send(self, command, light=None):
+        return self.send_nowait(command, light).result()
+
+    # Same as send, returns a Future for the result instead of waiting for it
+    def send_nowait(self, command, light=None):
+        if self.coalescer is None: return self.submit(command)
+        combine = light is not None and bool(light.light_control.can_combine_commands)
+        return self.coalescer.submit(command, combine=combine)
+
+    # Queues an interactive command, sharing the gateway fairly between groups
+    def schedule(self, command):
+        return self.submit(command).result()
+
+    # Same as schedule, without waiting for the result
+    def submit(self, command):
+        return self.scheduler.submit(command, fairness_key=self.fairness_key(command))
+
+    def fairness_key(self, command):
+        root, resource_id = command.path[0], command.path[-1]
+        if root == ROOT_DEVICES:
+            groups = self.registry.groups_of(resource_id)
+            if groups: return "group/" + str(groups[0].id)
+            return "light/" + str(resource_id)
+        return "group/" + str(resource_id)
+
+    # Ids are only unique per gateway, so they are prefixed with the gateway host when serving several gateways
+    def public_id(self, resource):
+        if len(gateways) == 1: return str(resource.id)
+        return self.host + ":" + str(resource.id)
+
+def find_light(light_id):
+    return find_resource(light_id, lambda registry, resource_id: registry.get_light(resource_id))
+
+def find_group(group_id):
+    return find_resource(group_id, lambda registry, resource_id: registry.get_group(resource_id))
+
+# An id without the gateway host only matches if exactly one gateway has the resource, otherwise the host is required
+def find_resource(public_id, get):
+    matches = []
+    for connection, resource_id in lookup_candidates(public_id):
+        resource = get(connection.registry, resource_id)
+        if resource is not None: matches.append((connection, resource))
+    if len(matches) != 1: return None, None
+    return matches[0]
+
+def lookup_candidates(public_id):
+    host, separator, resource_id = public_id.rpartition(":")
+    if separator: return [(connection, resource_id) for connection in gateways if connection.host == host]
+    return [(connection, public_id) for connection in gateways]
 
 # TODO
 # - add specific color-handling (not just temperature)
@@ -43,17 +209,13 @@ def get_lights():
       200:
         description: ok
         examples:
-          {"id": "99999", "name": "Bulb1", "state": "1", "level": "254", "color": "330" }
+          {"id": "99999", "name": "Bulb1", "state": 1, "level": 254, "color": 330, "updated": "2020-01-01T12:00:00.000000Z" }
+      304:
+        description: not modified since the version given in the 'If-None-Match' header
     """
-    lights_dict = list(map(lambda light: 
-        {   "id": str(light.raw.get(ATTR_ID)), 
-            "name": str(light.raw.get(ATTR_NAME)),
-            "state": str(light.light_control.raw[0].get(ATTR_DEVICE_STATE)),
-            "level": str(light.light_control.raw[0].get(ATTR_LIGHT_DIMMER)),
-            "color": str(light.light_control.raw[0].get(ATTR_LIGHT_MIREDS)) 
-        }, 
-        lights))
-    return jp.encode(lights_dict, unpicklable=False), 200, {'Content-Type': 'application/json'}
+    versions = [(connection.registry.devices_version, connection.registry.devices_modified) for connection in gateways]
+    return conditional_response("light", versions,
+        lambda: [(connection, light) for connection in gateways for light in connection.registry.lights], light_to_dict)
 
 @app.route('/light/<light_id>/state/<state_on_off>', methods=['PUT'])
 def set_light_state(light_id, state_on_off):
@@ -76,18 +238,7 @@ def set_light_state(light_id, state_on_off):
       400:
         description: Missing or invalid input
     """
-    if (state_on_off.lower() != 'on' and state_on_off.lower() != 'off'): return 400
-
-    state_boolean = True if (state_on_off.lower() == 'on') else False
-    filtered_lights = list(filter(lambda light: str(light.raw.get(ATTR_ID)) == light_id, lights))
-    if not filtered_lights: return 404 #light with submitted id was not found
-    
-    try:        
-        api(filtered_lights[0].light_control.set_state(state_boolean))    
-    except Exception as e:
-        app.logger.error(traceback.format_exc())
-        abort(500)
-    return 'Light ' + light_id + ', state set to: ' + state_on_off, 200
+    return operation_route(request.endpoint, request.view_args)
 
 
 @app.route('/light/<light_id>/color/<int:color_temp>', methods=['PUT'])
@@ -111,19 +262,7 @@ def set_light_color(light_id, color_temp):
       400:
         description: Missing or invalid input
     """
-    # Ensure color temp value is within allowed range of (250, 454)
-    if (color_temp < 250): color_temp = 250
-    if (color_temp > 454): color_temp = 454  
-
-    filtered_lights = list(filter(lambda light: str(light.raw.get(ATTR_ID)) == light_id, lights))
-    if not filtered_lights: return 404 #light with submitted id was not found
-    
-    try:        
-        api(filtered_lights[0].light_control.set_color_temp(color_temp))    
-    except Exception as e:
-        app.logger.error(traceback.format_exc())
-        abort(500)
-    return 'Light ' + light_id + ', color set to: ' + str(color_temp), 200
+    return operation_route(request.endpoint, request.view_args)
 
 @app.route('/light/<light_id>/level/<int:light_level>', methods=['PUT'])
 def set_light_light_level(light_id, light_level):
@@ -146,39 +285,24 @@ def set_light_light_level(light_id, light_level):
       400:
         description: Missing or invalid input
     """
-    # Ensure light level value is within allowed range of (0, 254)
-    if (light_level < 0): light_level = 0
-    if (light_level > 254): light_level = 254  
-
-    filtered_lights = list(filter(lambda light: str(light.raw.get(ATTR_ID)) == light_id, lights))
-    if not filtered_lights: return 404 #group with submitted id was not found
-    
-    try:        
-        api(filtered_lights[0].light_control.set_dimmer(light_level))    
-    except Exception as e:
-        app.logger.error(traceback.format_exc())
-        abort(500)
-    return 'Light ' + light_id + ', light level set to: ' + str(light_level), 200
+    return operation_route(request.endpoint, request.view_args)
 
 @app.route('/group', methods=['GET'])
 def get_groups():
     """Retrieve a list of all registered groups.
+    The state is derived from the reachable member lights: 'state' is 1 if any of them is on and 'all_on' tells whether all are, 'level' is their mean light level and 'color' their most common color temperature. Only the lights that are on are taken into account unless all are off.
     ---    
     responses:
       200:
         description: ok
         examples:
-          { "id": "99999", "name": "Group1", "state": "1", "level": "254", "color": "330" }
+          { "id": "99999", "name": "Group1", "state": 1, "level": 254, "color": 330, "all_on": false, "updated": "2020-01-01T12:00:00.000000Z" }
+      304:
+        description: not modified since the version given in the 'If-None-Match' header
     """
-    groups_dict = list(map(lambda group: 
-        {   "id": str(group.raw.get(ATTR_ID)), 
-            "name": str(group.raw.get(ATTR_NAME)),
-            "state": str(group.raw.get(ATTR_DEVICE_STATE)),
-            "level": str(group.raw.get(ATTR_LIGHT_DIMMER)),
-            "color": str(group.raw.get(ATTR_LIGHT_MIREDS))        
-        }, 
-        groups))
-    return jp.encode(groups_dict, unpicklable=False), 200, {'Content-Type': 'application/json'}
+    versions = [(connection.registry.groups_version, connection.registry.groups_modified) for connection in gateways]
+    return conditional_response("group", versions,
+        lambda: [(connection, group) for connection in gateways for group in connection.registry.groups], group_to_dict)
 
 @app.route('/group/<group_id>/state/<state_on_off>', methods=['PUT'])
 def set_group_state(group_id, state_on_off):
@@ -201,18 +325,7 @@ def set_group_state(group_id, state_on_off):
       400:
         description: Missing or invalid input
     """
-    if (state_on_off.lower() != 'on' and state_on_off.lower() != 'off'): return 400
-
-    state_boolean = True if (state_on_off.lower() == 'on') else False
-    filtered_groups = list(filter(lambda group: str(group.raw.get(ATTR_ID)) == group_id, groups))
-    if not filtered_groups: return 404 #group with submitted id was not found
-    
-    try:        
-        api(filtered_groups[0].set_state(state_boolean))    
-    except Exception as e:
-        app.logger.error(traceback.format_exc())
-        abort(500)
-    return 'Group ' + group_id + ', state set to: ' + state_on_off, 200
+    return operation_route(request.endpoint, request.view_args)
 
 @app.route('/group/<group_id>/color/<int:color_temp>', methods=['PUT'])
 def set_group_color(group_id, color_temp):
@@ -235,19 +348,7 @@ def set_group_color(group_id, color_temp):
       400:
         description: Missing or invalid input
     """
-    # Ensure color temp value is within allowed range of (250, 454)
-    if (color_temp < 250): color_temp = 250
-    if (color_temp > 454): color_temp = 454  
-
-    filtered_groups = list(filter(lambda group: str(group.raw.get(ATTR_ID)) == group_id, groups))
-    if not filtered_groups: return 404 #group with submitted id was not found
-    
-    try:        
-        api(filtered_groups[0].set_color_temp(color_temp))    
-    except Exception as e:
-        app.logger.error(traceback.format_exc())
-        abort(500)
-    return 'Group ' + group_id + ', color set to: ' + str(color_temp), 200
+    return operation_route(request.endpoint, request.view_args)
 
 @app.route('/group/<group_id>/level/<int:light_level>', methods=['PUT'])
 def set_group_light_level(group_id, light_level):
@@ -270,49 +371,587 @@ def set_group_light_level(group_id, light_level):
       400:
         description: Missing or invalid input
     """
-    # Ensure light level value is within allowed range of (0, 254)
-    if (light_level < 0): light_level = 0
-    if (light_level > 254): light_level = 254  
+    return operation_route(request.endpoint, request.view_args)
 
-    filtered_groups = list(filter(lambda group: str(group.raw.get(ATTR_ID)) == group_id, groups))
-    if not filtered_groups: return 404 #group with submitted id was not found
-    
-    try:        
-        api(filtered_groups[0].set_dimmer(light_level))    
+@app.route('/group/<group_id>/effect/<effect>', methods=['PUT'])
+def run_group_effect(group_id, effect):
+    """Run an effect on the lights of a light group.
+    The effect runs in the background, a new effect on the same lights replaces the running one. The lights move smoothly between sparse steps, so effects only take a share of the commands the gateway can handle.
+    ---
+    parameters:
+    - name: group_id
+      in: path
+      type: string
+      required: true
+      description: Valid parameter values can be retrieved via 'GET /group' endpoint.
+    - name: effect
+      in: path
+      type: string
+      required: true
+      description: "'sunrise' brightens the lights from a warm glow to cool daylight, 'fade' fades them to the given level, 'chase' lets a pulse of light run along them every duration and 'stop' stops the running effect."
+    - name: duration
+      in: query
+      type: number
+      required: false
+      description: Seconds the effect takes (default 60).
+    - name: level
+      in: query
+      type: int
+      required: false
+      description: Light level 'fade' ends at, within range (0, 254) (default 0).
+    - name: cycles
+      in: query
+      type: int
+      required: false
+      description: Number of times 'chase' runs along the lights (default 1).
+    responses:
+      202:
+        description: effect started
+      400:
+        description: Missing or invalid input
+      404:
+        description: group not found
+    """
+    if effect not in EFFECTS: abort(400, "Effect must be one of: " + ", ".join(EFFECTS))
+    duration = request.args.get("duration", 60, type=float)
+    level = min(max(request.args.get("level", 0, type=int), 0), 254)
+    cycles = request.args.get("cycles", 1, type=int)
+    if duration <= 0 or cycles < 1: abort(400, "Duration and cycles must be positive")
+
+    connection, group = find_group(group_id)
+    if group is None: abort(404)
+    lights = [device for device in connection.registry.members_of(group.id) if device.has_light_control and device.reachable]
+
+    if effect == "stop":
+        effects_loop.call_soon_threadsafe(connection.effects.stop, lights)
+        return 'Group ' + group_id + ', effect stopped', 200
+    if effect == "sunrise":
+        timeline = sunrise(lights, duration)
+    elif effect == "fade":
+        timeline = fade(lights, duration, dimmer=level)
+    else:
+        timeline = chase(lights, duration, cycles=cycles)
+    start_effect(connection, timeline)
+    return 'Group ' + group_id + ', effect ' + effect + ' started', 202
+
+@app.route('/batch', methods=['POST'])
+def run_batch():
+    """Run several light/group operations at once, e.g. to update a whole room.
+    ---
+    parameters:
+    - name: operations
+      in: body
+      required: true
+      description: List of operations. 'type' is either 'light' or 'group', 'action' is either 'state' (value 'on'/'off'), 'color' (value within range (250, 454)) or 'level' (value within range (0, 254)).
+      schema:
+        type: array
+        items:
+          type: object
+          properties:
+            type:
+              type: string
+            id:
+              type: string
+            action:
+              type: string
+            value:
+              type: string
+        example: [{"type": "light", "id": "99999", "action": "level", "value": 254}, {"type": "group", "id": "88888", "action": "state", "value": "off"}]
+    responses:
+      200:
+        description: ok, each operation has its own status
+        examples:
+          [{"type": "light", "id": "99999", "action": "level", "value": 254, "status": 200, "latency": 0.12}]
+      400:
+        description: Missing or invalid input
+    """
+    operations = request.get_json(silent=True)
+    if not isinstance(operations, list): return INVALID_BATCH, 400
+
+    results, pending = prepare_batch(operations)
+    futures = [(result, batch_executor.submit(timed_request, connection, command, light)) for result, connection, command, light in pending]
+    for result, future in futures:
+        try:
+            finish_operation(result, future.result())
+        except Exception as e:
+            finish_operation(result, error=e)
+    return dumps(results), 200, {'Content-Type': 'application/json'}
+
+INVALID_BATCH = 'Request body must be a JSON list of operations'
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Retrieve queue depth, wait times (seconds) and number of commands sent per priority for each gateway, the devices commands currently fail fast for and the number of lights on.
+    ---
+    responses:
+      200:
+        description: ok
+        examples:
+          {"192.168.1.145": {"interactive": {"queue_depth": 0, "sent": 12, "failed": 0, "wait_mean": 0.01, "wait_max": 0.05}, "in_flight": 1, "tokens": 19.5, "open_circuits": {"192.168.1.145 device 65537": "open"}, "lights_on": 4}}
+    """
+    metrics = {connection.host: dict(connection.scheduler.metrics(), open_circuits=connection.api_factory.breakers.open_circuits(),
+        lights_on=connection.registry.lights_on()) for connection in gateways}
+    return dumps(metrics), 200, {'Content-Type': 'application/json'}
+
+@app.route('/observations', methods=['GET'])
+def get_observations():
+    """Retrieve the health of the observations keeping lights and groups up to date, per gateway and resource path.
+    ---
+    responses:
+      200:
+        description: ok
+        examples:
+          {"192.168.1.145": {"15001/65537": {"state": "active", "subscribed_at": 1700000000.0, "last_update": 1700000100.0, "updates": 3, "subscriptions": 1, "failures": 0, "last_error": null}}}
+    """
+    health = {connection.host: connection.supervisor.health() for connection in gateways}
+    return dumps(health), 200, {'Content-Type': 'application/json'}
+
+@app.route('/events', methods=['GET'])
+def get_events():
+    """Stream changes of lights and groups as Server-Sent Events.
+    Events only contain the id and the fields that changed. A 'resync' event is sent when the client can't keep up and missed events, it should then retrieve the full state via 'GET /light' and 'GET /group'.
+    ---
+    parameters:
+    - name: id
+      in: query
+      type: string
+      required: false
+      description: Comma separated light/group ids to receive events for. Giving a group id includes events of its member lights. Defaults to all.
+    responses:
+      200:
+        description: ok
+        examples:
+          text/event-stream: "event: light\\ndata: {\\"id\\": \\"99999\\", \\"level\\": 128}\\n\\n"
+    """
+    stream = open_event_stream(request.args.get("id"))
+    return Response(stream.events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+# Events queued for one client of 'GET /events'
+class EventStream:
+    def __init__(self, ids, loop=None):
+        self.ids = ids
+        self.queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.loop = loop # wakes up events_async, which has to run on this loop
+        self.ready = asyncio.Event() if loop is not None else None
+
+    def wants(self, ids):
+        return self.ids is None or not self.ids.isdisjoint(ids)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Don't let a slow client hold back the others, drop its backlog and let it resync
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait(("resync", {}))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def events(self):
+        try:
+            while True:
+                try:
+                    event, data = self.queue.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_event(event, data)
+        finally:
+            self.close()
+
+    # Same as events, for streams created with the event loop of the ASGI server
+    async def events_async(self):
+        while True:
+            try:
+                event, data = self.queue.get_nowait()
+            except queue.Empty:
+                self.ready.clear()
+                if not self.queue.empty(): continue # put between get_nowait and clear
+                try:
+                    await asyncio.wait_for(self.ready.wait(), EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                continue
+            yield format_event(event, data)
+
+    def close(self):
+        with event_streams_lock:
+            event_streams.discard(self)
+
+def format_event(event, data):
+    return "event: " + event + "\ndata: " + dumps(data).decode("utf-8") + "\n\n"
+
+def open_event_stream(ids, loop=None):
+    stream = EventStream(set(ids.split(",")) if ids else None, loop)
+    with event_streams_lock:
+        event_streams.add(stream)
+    return stream
+
+def publish_change(connection, resource):
+    if isinstance(resource, Group):
+        event, state = "group", group_to_dict(connection, resource)
+        ids = {state["id"]}
+    elif resource.has_light_control:
+        event, state = "light", light_to_dict(connection, resource)
+        ids = {state["id"]} | {connection.public_id(group) for group in connection.registry.groups_of(resource.id)}
+    else:
+        return
+
+    previous = last_published.get((event, state["id"]), {})
+    last_published[(event, state["id"])] = state
+    delta = state
+    if previous:
+        delta = {key: value for key, value in state.items() if key == "id" or previous.get(key) != value}
+        if delta.keys() <= {"id", "updated"}: return # nothing but the timestamp changed
+
+    with event_streams_lock:
+        streams = [stream for stream in event_streams if stream.wants(ids)]
+    for stream in streams:
+        stream.put((event, delta))
+
+def batch_command(operation):
+    resource_type = operation.get("type")
+    action = operation.get("action")
+    value = operation.get("value")
+    if resource_type == "light":
+        connection, light = find_light(str(operation.get("id")))
+        if light is None: raise LookupError("Light not found")
+        control = light.light_control
+    elif resource_type == "group":
+        light = None
+        connection, control = find_group(str(operation.get("id")))
+        if control is None: raise LookupError("Group not found")
+    else:
+        raise ValueError("Type must be either 'light' or 'group'")
+
+    if action == "state":
+        if str(value).lower() not in ("on", "off"): raise ValueError("Value must be either 'on' or 'off'")
+        return connection, control.set_state(str(value).lower() == "on"), light
+    elif action == "color":
+        return connection, control.set_color_temp(clamp_value(action, value)), light
+    elif action == "level":
+        return connection, control.set_dimmer(clamp_value(action, value)), light
+    raise ValueError("Action must be either 'state', 'color' or 'level'")
+
+# Color temperature within range (250, 454), light level within range (0, 254)
+def clamp_value(action, value):
+    if action == "color": return min(max(int(value), 250), 454)
+    if action == "level": return min(max(int(value), 0), 254)
+    return value
+
+# The PUT routes of lights and groups each run a single operation of a batch: endpoint -> type, action, id and value arguments
+OPERATION_ROUTES = {
+    "set_light_state": ("light", "state", "light_id", "state_on_off"),
+    "set_light_color": ("light", "color", "light_id", "color_temp"),
+    "set_light_light_level": ("light", "level", "light_id", "light_level"),
+    "set_group_state": ("group", "state", "group_id", "state_on_off"),
+    "set_group_color": ("group", "color", "group_id", "color_temp"),
+    "set_group_light_level": ("group", "level", "group_id", "light_level"),
+}
+ACTION_NAMES = {"state": "state", "color": "color", "level": "light level"}
+
+def route_operation(endpoint, view_args):
+    resource_type, action, id_arg, value_arg = OPERATION_ROUTES[endpoint]
+    return {"type": resource_type, "id": view_args[id_arg], "action": action, "value": view_args[value_arg]}
+
+def operation_message(operation):
+    return (operation["type"].capitalize() + " " + operation["id"] + ", " + ACTION_NAMES[operation["action"]] +
+        " set to: " + str(clamp_value(operation["action"], operation["value"])))
+
+def operation_route(endpoint, view_args):
+    operation = route_operation(endpoint, view_args)
+    try:
+        connection, command, light = batch_command(operation)
+    except (LookupError, ValueError, TypeError) as e:
+        abort(invalid_status(e), str(e))
+    try:
+        connection.send(command, light)
     except Exception as e:
+        abort(failed_status(e), str(e))
+    return operation_message(operation), 200
+
+# Status of an operation that couldn't be sent
+def invalid_status(error):
+    return 404 if isinstance(error, LookupError) else 400
+
+# Status of an operation the gateway didn't carry out
+def failed_status(error):
+    if isinstance(error, CircuitOpenError): return 503
+    app.logger.error("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+    return 500
+
+def prepare_batch(operations):
+    results = [dict(operation) if isinstance(operation, dict) else {"operation": operation} for operation in operations]
+    pending = []
+    for result in results:
+        try:
+            connection, command, light = batch_command(result)
+        except (LookupError, ValueError, TypeError) as e:
+            result.update(status=invalid_status(e), error=str(e))
+        else:
+            pending.append((result, connection, command, light))
+    return results, pending
+
+def finish_operation(result, latency=None, error=None):
+    if error is None:
+        result["latency"] = latency
+        result["status"] = 200
+    else:
+        result.update(status=failed_status(error), error=str(error))
+
+# Effects are started on the effects loop, which sends their commands through the scheduler of the gateway
+def start_effect(connection, timeline):
+    async def start():
+        return connection.effects.start(timeline)
+    return asyncio.run_coroutine_threadsafe(start(), effects_loop).result()
+
+def timed_request(connection, command, light=None):
+    start = time.monotonic()
+    connection.send(command, light)
+    return round(time.monotonic() - start, 3)
+
+async def timed_request_async(connection, command, light=None):
+    start = time.monotonic()
+    await asyncio.wrap_future(connection.send_nowait(command, light))
+    return round(time.monotonic() - start, 3)
+
+# Serves the routes that wait for the gateway on the event loop of the ASGI server ('--server asgi'), so waiting
+# requests don't hold a thread each. All other routes are answered from memory and are served by the Flask app.
+class AsgiServer:
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WSGIMiddleware(app)
+
+    async def __call__(self, scope, receive, send):
+        endpoint, view_args = None, {}
+        if scope["type"] == "http":
+            try:
+                endpoint, view_args = self.app.url_map.bind("localhost").match(scope["path"], method=scope["method"])
+            except HTTPException:
+                pass
+
+        if endpoint in OPERATION_ROUTES:
+            await self.run_operation(route_operation(endpoint, view_args), send)
+        elif endpoint == "run_batch":
+            await self.run_batch(receive, send)
+        elif endpoint == "get_events":
+            await self.stream_events(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def run_operation(self, operation, send):
+        try:
+            connection, command, light = batch_command(operation)
+        except (LookupError, ValueError, TypeError) as e:
+            return await self.send_error(send, invalid_status(e), str(e))
+        try:
+            await asyncio.wrap_future(connection.send_nowait(command, light))
+        except Exception as e:
+            return await self.send_error(send, failed_status(e), str(e))
+        await self.send_response(send, 200, operation_message(operation).encode("utf-8"))
+
+    async def run_batch(self, receive, send):
+        try:
+            operations = json.loads(await self.read_body(receive))
+        except ValueError:
+            operations = None
+        if not isinstance(operations, list):
+            return await self.send_response(send, 400, INVALID_BATCH.encode("utf-8"))
+
+        results, pending = prepare_batch(operations)
+        latencies = await asyncio.gather(*(timed_request_async(connection, command, light)
+            for _, connection, command, light in pending), return_exceptions=True)
+        for (result, _, _, _), latency in zip(pending, latencies):
+            if isinstance(latency, Exception): finish_operation(result, error=latency)
+            else: finish_operation(result, latency)
+        await self.send_response(send, 200, dumps(results), "application/json")
+
+    async def stream_events(self, scope, receive, send):
+        ids = parse_qs(scope["query_string"].decode("latin-1")).get("id", [None])[0]
+        stream = open_event_stream(ids, asyncio.get_running_loop())
+        # Sending doesn't fail once the client is gone, so stop streaming when it disconnects
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache")]})
+            events = stream.events_async()
+            while not disconnected.done():
+                next_event = asyncio.ensure_future(events.__anext__())
+                await asyncio.wait([next_event, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if not next_event.done():
+                    next_event.cancel()
+                    break
+                await send({"type": "http.response.body", "body": next_event.result().encode("utf-8"), "more_body": True})
+        finally:
+            stream.close()
+            disconnected.cancel()
+
+    async def read_body(self, receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"): return body
+
+    async def wait_disconnect(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    async def send_response(self, send, status, body, content_type="text/html; charset=utf-8"):
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type.encode("latin-1"))]})
+        await send({"type": "http.response.body", "body": body})
+
+    # Same error page as abort() in the Flask app
+    async def send_error(self, send, status, description):
+        error = default_exceptions[status](description)
+        await self.send_response(send, status, error.get_body().encode("utf-8"))
+
+def light_to_dict(connection, light):
+    light_raw = light.raw[ATTR_LIGHT_CONTROL][0]
+    return {"id": connection.public_id(light),
+            "name": light.raw.get(ATTR_NAME),
+            "state": light_raw.get(ATTR_DEVICE_STATE),
+            "level": light_raw.get(ATTR_LIGHT_DIMMER),
+            "color": light_raw.get(ATTR_LIGHT_MIREDS),
+            "updated": format_timestamp(connection.registry.last_updated(light))}
+
+# The gateway only updates the state of a group when the group itself is set, so it is derived from the members
+# that are reachable lights. The group state of the gateway is only used for groups without any.
+def group_to_dict(connection, group):
+    aggregate = connection.registry.aggregate(group.id)
+    if aggregate is None or not aggregate.lights:
+        return {"id": connection.public_id(group),
+                "name": group.raw.get(ATTR_NAME),
+                "state": group.raw.get(ATTR_DEVICE_STATE),
+                "level": group.raw.get(ATTR_LIGHT_DIMMER),
+                "color": group.raw.get(ATTR_LIGHT_MIREDS),
+                "all_on": None,
+                "updated": format_timestamp(connection.registry.last_updated(group))}
+    return {"id": connection.public_id(group),
+            "name": group.raw.get(ATTR_NAME),
+            "state": int(aggregate.any_on),
+            "level": None if aggregate.dimmer_mean is None else round(aggregate.dimmer_mean),
+            "color": aggregate.mireds,
+            "all_on": aggregate.all_on,
+            "updated": format_timestamp(connection.registry.last_updated(group))}
+
+# Returns the encoded list of resources, or 304 if the client already has the current version.
+# The ETag is built from the registry versions, so unchanged lists are neither re-serialized nor re-sent.
+def conditional_response(name, versions, resources, to_dict):
+    etag = name + "-" + server_id + "-" + "-".join(str(version) for version, _ in versions)
+    modified = [modified for _, modified in versions if modified is not None]
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        cached_etag, body = response_cache.get(name, (None, None))
+        if cached_etag != etag:
+            body = dumps([to_dict(connection, resource) for connection, resource in resources()])
+            response_cache[name] = (etag, body)
+        response = app.response_class(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    if modified: response.last_modified = datetime.utcfromtimestamp(max(modified))
+    return response
+
+def format_timestamp(timestamp):
+    if timestamp is None: return None
+    return datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def on_resource_updated(connection, resource):
+    if isinstance(resource, Group):
+        connection.registry.add_group(resource) # membership may have changed
+    else:
+        connection.api_factory.breakers.update_device(resource) # commands fail fast while the device is unreachable
+        connection.registry.touch(resource)
+        for group in connection.registry.groups_of(resource.id):
+            publish_change(connection, group) # only published if the state derived from the members changed
+    publish_change(connection, resource)
+
+# Keeps the in-memory state of lights and groups current by observing them on the gateway.
+# The supervisor renews the observations before they expire and resubscribes failed ones.
+def start_observing(connection):
+    for resource in connection.registry.devices + connection.registry.groups:
+        connection.supervisor.observe(resource, lambda resource, connection=connection: on_resource_updated(connection, resource))
+
+# Serves the snapshot of the gateway right away if there is one and reconciles it with the gateway in the background
+def connect(host, identity, psk, args):
+    connection = GatewayConnection(host, identity, psk, args)
+    if connection.restore():
+        connection.log_resources()
+        start_observing(connection)
+        threading.Thread(target=reconcile, args=(connection,), name="reconcile-" + host, daemon=True).start()
+    else:
+        connection.refresh()
+        connection.log_resources()
+        start_observing(connection)
+    return connection
+
+def reconcile(connection):
+    try:
+        connection.refresh()
+    except Exception as e:
+        app.logger.error("Failed to reconcile %s, serving its snapshot", connection.host)
         app.logger.error(traceback.format_exc())
-        abort(500)
-    return 'Group ' + group_id + ', light level set to: ' + str(light_level), 200
+        return
+    # Refreshing replaced the restored lights and groups, observe the new ones instead
+    start_observing(connection)
+
+def save_snapshots():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        for connection in gateways:
+            connection.save_snapshot()
 
 
 # Initialization of server for retrieving lights/groups from IKEA Tradfri Gateway
 if __name__ == '__main__':
     CONFIG_FILE = "tradfri_standalone_psk.conf"
-    IP_ADDRESS = "192.168.1.145"
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["libcoap", "aiocoap"], default="libcoap",
+        help="'libcoap' runs a coap-client process per command, 'aiocoap' shares persistent DTLS sessions on one event loop")
+    parser.add_argument("--server", choices=["flask", "asgi"], default="flask",
+        help="'flask' serves each HTTP request on its own thread, 'asgi' serves them with uvicorn on one event loop, "
+             "so requests waiting for the gateway don't hold a thread (requires uvicorn)")
+    parser.add_argument("--pool-size", type=int, default=1,
+        help="Number of DTLS sessions kept open to the gateway (aiocoap backend only)")
+    parser.add_argument("--max-in-flight", type=int, default=4,
+        help="Max number of commands sent to the gateway at once")
+    parser.add_argument("--rate", type=float, default=20,
+        help="Max number of commands sent to the gateway per second")
+    parser.add_argument("--discovery-workers", type=int, default=8,
+        help="Max number of resources fetched at once while discovering a gateway")
+    parser.add_argument("--flush-interval", type=float, default=0.1,
+        help="Seconds to collect commands for the same light/group before merging and sending them, 0 to disable")
+    parser.add_argument("--snapshot-dir", default="snapshots",
+        help="Directory of the snapshot files the last known state of the gateways is served from on startup, empty to disable")
+    args = parser.parse_args()
+    if args.server == "asgi" and uvicorn is None: parser.error("'--server asgi' requires uvicorn")
     
     try:
         conf = load_json(CONFIG_FILE)
         app.logger.warning("Config file contents: '")    
         app.logger.warning(conf)
         app.logger.warning("'")
-        identity = conf[IP_ADDRESS].get("identity")
-        psk = conf[IP_ADDRESS].get("key")
-    
-        api_factory = APIFactory(IP_ADDRESS, identity, psk)        
-        api = api_factory.request
-        gateway = Gateway()
-
-        app.logger.warning("-- LIGHTS --")
-        devices_command = api(gateway.get_devices())
-        devices = api(devices_command)
-        lights = [dev for dev in devices if dev.has_light_control]
-        app.logger.warning(lights)
-
-        app.logger.warning("-- GROUPS --")
-        groups_command = api(gateway.get_groups())
-        groups = api(groups_command)     
-        app.logger.warning(groups)        
+        app.logger.warning("Using backend: " + args.backend)
+
+        # Gateways are connected in parallel so startup time doesn't grow with the number of gateways
+        with ThreadPoolExecutor(max_workers=max(len(conf), 1)) as executor:
+            futures = {host: executor.submit(connect, host, entry.get("identity"), entry.get("key"), args) for host, entry in conf.items()}
+            for host, future in futures.items():
+                try:
+                    gateways.append(future.result())
+                except Exception as e:
+                    app.logger.error("Failed to connect to gateway %s", host)
+                    app.logger.error(traceback.format_exc())
+
+        threading.Thread(target=save_snapshots, name="snapshots", daemon=True).start()
     except Exception as e:
         app.logger.error(traceback.format_exc())   
 
-    app.run(host="0.0.0.0", port=5000)
+    threading.Thread(target=effects_loop.run_forever, name="effects", daemon=True).start()
+    if args.server == "asgi":
+        uvicorn.run(AsgiServer(app), host="0.0.0.0", port=5000, lifespan="off")
+    else:
+        app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# Compares processing gateway responses with the old str based _process_output and the current bytes based one.
+# Usage (from repo root): PYTHONPATH=docker-baseimage python3 benchmarks/process_output.py
+# orjson is used for parsing when installed.
+import json
+import logging
+import timeit
+
+from pytradfri.api.libcoap_api import _process_output
+from pytradfri.util import orjson
+
+ROUNDS = 2000
+
+DEVICE_LIST = json.dumps([65536 + i for i in range(150)]).encode("utf-8") + b"\n"
+DEVICE = json.dumps({
+    "9001": "Living room bulb", "9002": 1563451327, "9003": 65550, "9019": 1, "9020": 1600000000, "9054": 0, "5750": 2,
+    "3": {"0": "IKEA of Sweden", "1": "TRADFRI bulb E27 CWS opal 600lm", "2": "", "3": "2.3.050", "6": 1},
+    "3311": [{"5706": "f1e0b5", "5707": 5427, "5708": 42596, "5709": 30140, "5710": 26909, "5711": 370, "5850": 1, "5851": 254, "9003": 0}],
+}).encode("utf-8") + b"\n"
+
+def old_process_output(output, parse_json=True):
+    # Implementation before processing bytes: decode, strip and log unconditionally
+    output = output.decode("utf-8").strip()
+    logging.getLogger(__name__).debug("Received: %s", output)
+    if not output:
+        return None
+    elif "decrypt_verify" in output:
+        raise ValueError()
+    elif output.startswith("4.") or output.startswith("5."):
+        raise ValueError()
+    return json.loads(output)
+
+if __name__ == '__main__':
+    print("%d rounds, orjson %s" % (ROUNDS, "installed" if orjson else "not installed"))
+    for name, payload in (("device list", DEVICE_LIST), ("device", DEVICE)):
+        for implementation in (old_process_output, _process_output):
+            seconds = min(timeit.repeat(lambda: implementation(payload), number=ROUNDS, repeat=3)) / ROUNDS
+            print("%-12s %-20s %7.2f us/response" % (name, implementation.__name__, seconds * 1e6))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Compares encoding 'GET /light' for 500 lights with the old jsonpickle path and the server's own code path.
+# Usage (from repo root): PYTHONPATH=docker-baseimage python3 benchmarks/serialization.py
+# Requires jsonpickle for the old path and the server's dependencies (flask, flasgger); orjson is used when installed.
+import os
+import sys
+import timeit
+
+import jsonpickle as jp
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")))
+import app as server
+from pytradfri.device import Device
+from pytradfri.registry import Registry
+from pytradfri.util import dumps, orjson
+from pytradfri.const import ATTR_ID, ATTR_NAME, ATTR_DEVICE_STATE, ATTR_LIGHT_DIMMER, ATTR_LIGHT_MIREDS
+
+DEVICES = 500
+ROUNDS = 20
+
+lights = [Device({
+    "9003": 65536 + i, "9001": "Bulb %d" % i, "5750": 2, "9019": 1,
+    "3": {"0": "IKEA of Sweden", "1": "TRADFRI bulb E27 WS opal 980lm", "3": "2.3.050", "6": 1},
+    "3311": [{"5850": 1, "5851": i % 255, "5711": 250 + i % 200, "5706": "f1e0b5", "5709": 30138, "5710": 26909, "9003": 0}],
+}) for i in range(DEVICES)]
+
+# Only what the GET /light handler reads of a GatewayConnection, without connecting to a gateway
+class Connection:
+    host = "192.168.1.145"
+
+    def __init__(self):
+        self.registry = Registry()
+        self.registry.set_devices(lights)
+
+    def public_id(self, resource):
+        return str(resource.id)
+
+connection = Connection()
+server.gateways.append(connection)
+
+def jsonpickle_path():
+    lights_dict = list(map(lambda light:
+        {   "id": str(light.raw.get(ATTR_ID)),
+            "name": str(light.raw.get(ATTR_NAME)),
+            "state": str(light.light_control.raw[0].get(ATTR_DEVICE_STATE)),
+            "level": str(light.light_control.raw[0].get(ATTR_LIGHT_DIMMER)),
+            "color": str(light.light_control.raw[0].get(ATTR_LIGHT_MIREDS))
+        },
+        lights))
+    return jp.encode(lights_dict, unpicklable=False)
+
+def serializer_path():
+    # What the server encodes whenever a light has changed since the last request
+    return dumps([server.light_to_dict(connection, light) for light in connection.registry.lights])
+
+def cached_path():
+    # What the server does when no light has changed since the last request
+    with server.app.test_request_context("/light"):
+        return server.get_lights()
+
+if __name__ == '__main__':
+    print("%d lights, %d rounds, orjson %s" % (DEVICES, ROUNDS, "installed" if orjson else "not installed"))
+    for name, path in (("jsonpickle", jsonpickle_path), ("serializer", serializer_path), ("serializer (cached)", cached_path)):
+        seconds = min(timeit.repeat(path, number=ROUNDS, repeat=3)) / ROUNDS
+        print("%-20s %8.3f ms/request" % (name, seconds * 1000))
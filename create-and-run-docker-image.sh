@@ -5,6 +5,7 @@ set -e
 
 DOCKERFILE="Dockerfile"
 DOCKER_IMAGE_NAME="ikea-homelight-api-server"
+SNAPSHOT_VOLUME="ikea-homelight-snapshots"
 OSX_TZ=$(ls -la /etc/localtime | cut -d/ -f8-9)
 MACHINE=$(uname -m)
 PWD=$(pwd)
@@ -15,4 +16,5 @@ docker rm -f $DOCKER_RUNNING_CONTAINER_ID || true
 
 docker build -t $DOCKER_IMAGE_NAME -f "$PWD/$DOCKERFILE" .
 
-docker run -d -p 5000:5000 --env "TZ=$OSX_TZ" --rm $DOCKER_IMAGE_NAME
+# the snapshots of the gateways are kept in a volume, so a new container starts serving right away
+docker run -d -p 5000:5000 --env "TZ=$OSX_TZ" --volume "$SNAPSHOT_VOLUME:/usr/src/app/snapshots" --rm $DOCKER_IMAGE_NAME
@@ -7,6 +7,9 @@ from .error import (
     ClientError,
     ServerError,
     RequestTimeout,
+    BatchError,
+    CircuitOpenError,
+    StopObserving,
 )
 from .gateway import Gateway
 
@@ -17,6 +20,9 @@ __all__ = [
     "ClientError",
     "ServerError",
     "RequestTimeout",
+    "BatchError",
+    "CircuitOpenError",
+    "StopObserving",
 ]
 
 __version__ = (Path(__file__).parent / "VERSION").read_text().strip()
@@ -0,0 +1,215 @@
+"""Group state derived from the state of the member devices.
+
+The gateway only updates the state of a group when the group itself is
+set, so it goes stale as soon as a single member changes. The aggregates
+are kept up to date incrementally as member devices are updated, reading
+them doesn't touch the members.
+"""
+from collections import Counter
+import threading
+
+
+def _key(resource_id):
+    return str(resource_id)
+
+
+class GroupAggregate:
+    """State of a group as derived from its reachable member lights.
+
+    The dimmer and mireds are taken from the lights that are on, or from all
+    lights while the whole group is off. Values are None if no member light
+    is known.
+    """
+
+    __slots__ = (
+        "lights",
+        "lights_on",
+        "any_on",
+        "all_on",
+        "dimmer_mean",
+        "dimmer_min",
+        "dimmer_max",
+        "mireds",
+    )
+
+    def __init__(self, lights, lights_on, dimmers, mireds):
+        self.lights = lights
+        self.lights_on = lights_on
+        self.any_on = lights_on > 0
+        self.all_on = lights > 0 and lights_on == lights
+        if dimmers:
+            total = sum(dimmer * count for dimmer, count in dimmers.items())
+            self.dimmer_mean = total / sum(dimmers.values())
+            self.dimmer_min = min(dimmers)
+            self.dimmer_max = max(dimmers)
+        else:
+            self.dimmer_mean = self.dimmer_min = self.dimmer_max = None
+        self.mireds = mireds.most_common(1)[0][0] if mireds else None
+
+    def __eq__(self, other):
+        if not isinstance(other, GroupAggregate):
+            return NotImplemented
+        return all(
+            getattr(self, slot) == getattr(other, slot) for slot in self.__slots__
+        )
+
+    def __repr__(self):
+        return "<GroupAggregate {}/{} on, dimmer: {}, mireds: {}>".format(
+            self.lights_on, self.lights, self.dimmer_mean, self.mireds
+        )
+
+
+class _Values:
+    """Multisets of the dimmer and mireds of some lights."""
+
+    __slots__ = ("dimmers", "mireds")
+
+    def __init__(self):
+        self.dimmers = Counter()
+        self.mireds = Counter()
+
+    def add(self, dimmer, mireds, count=1):
+        if dimmer is not None:
+            self.dimmers[dimmer] += count
+            if self.dimmers[dimmer] <= 0:
+                del self.dimmers[dimmer]
+        if mireds is not None:
+            self.mireds[mireds] += count
+            if self.mireds[mireds] <= 0:
+                del self.mireds[mireds]
+
+
+class _GroupState:
+    __slots__ = ("member_ids", "lights", "lights_on", "all", "on", "aggregate")
+
+    def __init__(self, member_ids):
+        self.member_ids = member_ids
+        self.lights = 0
+        self.lights_on = 0
+        self.all = _Values()
+        self.on = _Values()
+        self.aggregate = None
+
+    def add(self, light, count=1):
+        """Add (count=1) or remove (count=-1) the state of a light."""
+        state, dimmer, mireds = light
+        self.lights += count
+        self.all.add(dimmer, mireds, count)
+        if state:
+            self.lights_on += count
+            self.on.add(dimmer, mireds, count)
+
+    def summarize(self):
+        """Update the aggregate, returns True if it changed."""
+        values = self.on if self.lights_on else self.all
+        aggregate = GroupAggregate(
+            self.lights, self.lights_on, values.dimmers, values.mireds
+        )
+        changed = aggregate != self.aggregate
+        self.aggregate = aggregate
+        return changed
+
+
+def _light(device):
+    """Return the contribution of the device, None if it has none."""
+    model = device.model
+    if not model.reachable or not model.lights:
+        return None
+    light = model.lights[0]
+    return (light.state, light.dimmer, light.mireds)
+
+
+class GroupAggregates:
+    """Maintain the aggregate state of every group.
+
+    The last contribution of every device is kept, so updating a device
+    only adjusts the counts of its groups by the difference.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lights = {}  # device id -> (state, dimmer, mireds)
+        self._groups = {}  # group id -> _GroupState
+        self._device_groups = {}  # device id -> set of group ids
+
+    def get(self, group_id):
+        """Return the GroupAggregate of the group or None."""
+        group = self._groups.get(_key(group_id))
+        return None if group is None else group.aggregate
+
+    def set_group(self, group_id, member_ids):
+        """Add a group or update its members."""
+        key = _key(group_id)
+        member_ids = frozenset(_key(member_id) for member_id in member_ids)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None and group.member_ids == member_ids:
+                return
+            self._remove_group(key)
+            group = self._groups[key] = _GroupState(member_ids)
+            for member_id in member_ids:
+                self._device_groups.setdefault(member_id, set()).add(key)
+                light = self._lights.get(member_id)
+                if light is not None:
+                    group.add(light)
+            group.summarize()
+
+    def retain_groups(self, group_ids):
+        """Remove all groups except the given ones."""
+        keep = {_key(group_id) for group_id in group_ids}
+        with self._lock:
+            for key in [key for key in self._groups if key not in keep]:
+                self._remove_group(key)
+
+    def update_device(self, device):
+        """Apply the current state of the device to its groups.
+
+        Returns the ids of the groups whose aggregate changed.
+        """
+        key = _key(device.id)
+        light = _light(device)
+        with self._lock:
+            previous = self._lights.get(key)
+            if light == previous:
+                return []
+            if light is None:
+                del self._lights[key]
+            else:
+                self._lights[key] = light
+            return self._apply(key, previous, light)
+
+    def retain_devices(self, device_ids):
+        """Forget all devices except the given ones.
+
+        Returns the ids of the groups whose aggregate changed.
+        """
+        keep = {_key(device_id) for device_id in device_ids}
+        changed = set()
+        with self._lock:
+            for key in [key for key in self._lights if key not in keep]:
+                previous = self._lights.pop(key)
+                changed.update(self._apply(key, previous, None))
+        return list(changed)
+
+    def _apply(self, key, previous, light):
+        changed = []
+        for group_id in self._device_groups.get(key, ()):
+            group = self._groups[group_id]
+            if previous is not None:
+                group.add(previous, -1)
+            if light is not None:
+                group.add(light)
+            if group.summarize():
+                changed.append(group_id)
+        return changed
+
+    def _remove_group(self, key):
+        group = self._groups.pop(key, None)
+        if group is None:
+            return
+        for member_id in group.member_ids:
+            group_ids = self._device_groups.get(member_id)
+            if group_ids is not None:
+                group_ids.discard(key)
+                if not group_ids:
+                    del self._device_groups[member_id]
@@ -2,6 +2,7 @@
 import asyncio
 import json
 import logging
+from time import monotonic
 
 from aiocoap import Message, Context
 from aiocoap.credentials import CredentialsMissingError
@@ -10,33 +11,106 @@ from aiocoap.error import (
     Error,
     ConstructionRenderableError,
     LibraryShutdown,
+    NetworkError,
 )
 from aiocoap.numbers.codes import Code
 
-from ..error import ClientError, ServerError, RequestTimeout
+from ..error import (
+    ClientError,
+    ServerError,
+    RequestError,
+    RequestTimeout,
+    StopObserving,
+)
 from ..gateway import Gateway
+from ..util import loads
+from .breaker import CircuitBreakers
+from .retry import Attempts, RetryPolicy
 
 _LOGGER = logging.getLogger(__name__)
 _SENTINEL = object()
 
+# Timeouts of this many different resources in a row, without any response
+# in between, mean the DTLS session is gone rather than a single device.
+TRANSPORT_TIMEOUT_RESOURCES = 3
+# Observations expiring sooner than this after a reset are not re-established,
+# their callers are told they stopped instead.
+MIN_RESUBSCRIBE_DURATION = 5  # seconds
+
+
+class _Observation:
+    """An observation that is re-established when the protocol is reset."""
+
+    def __init__(self, api_command, expires_at):
+        self.api_command = api_command
+        self.expires_at = expires_at  # monotonic, None to never expire
+        self.observation = None
+        self.timer = None
+        self.stopped = False
+
+    @property
+    def remaining(self):
+        """Seconds until the observation expires, None if it never does."""
+        if self.expires_at is None:
+            return None
+        return self.expires_at - monotonic()
+
+    def detach(self):
+        """Forget the aiocoap observation, e.g. when its protocol is gone."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        observation, self.observation = self.observation, None
+        return observation
+
+    def stop(self):
+        self.stopped = True
+        observation = self.detach()
+        if observation is not None and not observation.cancelled:
+            observation.cancel()
+
 
 class APIFactory:
-    def __init__(self, host: str, psk_id="pytradfri", psk=None, internal_create=None):
+    def __init__(
+        self,
+        host: str,
+        psk_id="pytradfri",
+        psk=None,
+        internal_create=None,
+        retry_policy=None,
+        breakers=None,
+    ):
         if internal_create is not _SENTINEL:
             raise ValueError("Use APIFactory.init(…) to initialize APIFactory")
 
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._breakers = breakers or CircuitBreakers(host)
         self._psk = psk
         self._host = host
         self._psk_id = psk_id
-        self._observations_err_callbacks = []
+        self._observations = set()
+        self._timed_out_paths = set()
         self._protocol = None
         self._reset_lock = asyncio.Lock()
         self._shutdown = False
 
     @classmethod
-    async def init(cls, host, psk_id="pytradfri", psk=None) -> "APIFactory":
-        """Initialize an APIFactory."""
-        instance = cls(host, psk_id=psk_id, psk=psk, internal_create=_SENTINEL)
+    async def init(
+        cls, host, psk_id="pytradfri", psk=None, retry_policy=None, breakers=None
+    ) -> "APIFactory":
+        """Initialize an APIFactory.
+
+        The retry policy and circuit breakers may be shared by factories of
+        the same gateway.
+        """
+        instance = cls(
+            host,
+            psk_id=psk_id,
+            psk=psk,
+            internal_create=_SENTINEL,
+            retry_policy=retry_policy,
+            breakers=breakers,
+        )
         if psk:
             await instance._update_credentials()
         return instance
@@ -49,18 +123,35 @@ class APIFactory:
     def psk(self):
         return self._psk
 
+    @property
+    def retry_policy(self):
+        return self._retry_policy
+
+    @property
+    def breakers(self):
+        return self._breakers
+
+    @property
+    def observations(self):
+        """Number of running observations."""
+        return len(self._observations)
+
     async def _get_protocol(self):
         """Get the protocol for the request."""
         if self._protocol is None:
             self._protocol = asyncio.create_task(Context.create_client_context())
-        return await self._protocol
+        # Shared by all requests, a cancelled request must not cancel it.
+        return await asyncio.shield(self._protocol)
 
     async def _reset_protocol(self, exc=None):
-        """Reset the protocol if an error occurs."""
+        """Reset the protocol if an error occurs.
+
+        Returns True if the protocol was reset by this call.
+        """
         skip = self._reset_lock.locked()
         async with self._reset_lock:
             if self._shutdown:
-                return
+                return False
             if skip:
                 # The lock was already acquired, so another task was already
                 # in the process of resetting the protocol, so we don't need
@@ -69,54 +160,104 @@ class APIFactory:
                 # This is only here for performance reasons.  It should be
                 # safe if the protocol is reset multiple times.
                 _LOGGER.debug("Skipping reset: protocol was already being reset")
-                return
+                return False
 
             _LOGGER.debug("Resetting protocol")
 
+            # The observations are bound to the protocol. Their error
+            # callbacks are called with LibraryShutdown when shutting down.
+            for observation in self._observations:
+                observation.detach()
+
             # Be responsible and clean up.
             protocol = await self._get_protocol()
             await protocol.shutdown()
             self._protocol = None
+            self._timed_out_paths.clear()
+            return True
 
-            # The error callbacks are called when shutting down the protocol.
-            # Clear the saved callbacks
-            self._observations_err_callbacks.clear()
+    async def _recover(self, exc):
+        """Start a new DTLS session after a transport failure.
+
+        Only the observations are re-established, other requests in flight
+        fail and are retried by their callers.
+        """
+        _LOGGER.warning("Resetting connection to %s: %r", self._host, exc)
+        if not await self._reset_protocol(exc):
+            return
+        await self._update_credentials()
+
+        observations = [o for o in self._observations if not o.stopped]
+        if observations:
+            asyncio.ensure_future(self._resubscribe(observations))
 
     async def shutdown(self, exc=None):
         """Shutdown the API events.
-        This should be called before closing the event loop."""
+        This should be called before closing the event loop.
+
+        Running observations are stopped and their callers told so.
+        """
+        for observation in list(self._observations):
+            self._stop_observation(observation, RequestError("Observing stopped."))
         await self._reset_protocol(exc)
         self._shutdown = True
 
     async def _get_response(self, msg):
-        """Perform the request, get the response."""
+        """Perform the request, get the response.
+
+        Errors of a single request leave the protocol alone. It is only reset
+        on transport failures, which would fail every request. Recovering is
+        shielded, so a request cancelled meanwhile doesn't interrupt it.
+        """
         try:
             protocol = await self._get_protocol()
             pr = protocol.request(msg)
             r = await pr.response
-            return pr, r
         except CredentialsMissingError as e:
-            await self._reset_protocol(e)
-            await self._update_credentials()
+            await asyncio.shield(self._recover(e))
             raise ServerError("There was an error with the request.", e)
         except ConstructionRenderableError as e:
             raise ClientError("There was an error with the request.", e)
         except RequestTimedOut as e:
-            await self._reset_protocol(e)
-            await self._update_credentials()
+            # Usually a single unreachable device, unless different
+            # resources keep timing out.
+            self._timed_out_paths.add(tuple(msg.opt.uri_path))
+            if len(self._timed_out_paths) >= TRANSPORT_TIMEOUT_RESOURCES:
+                await asyncio.shield(self._recover(e))
             raise RequestTimeout("Request timed out.", e)
         except LibraryShutdown:
             raise
+        except NetworkError as e:
+            await asyncio.shield(self._recover(e))
+            raise ServerError("There was an error with the request.", e)
         except Error as e:
-            await self._reset_protocol(e)
-            await self._update_credentials()
             raise ServerError("There was an error with the request.", e)
-        except asyncio.CancelledError as e:
-            await self._reset_protocol(e)
-            await self._update_credentials()
-            raise e
 
-    async def _execute(self, api_command):
+        self._timed_out_paths.clear()
+        return pr, r
+
+    async def _get_response_retrying(self, api_command, msg, timeout=None):
+        """Perform the request, retrying as the retry policy allows.
+
+        Timeout limits all attempts together in seconds.
+        """
+        attempts = Attempts(self._retry_policy, api_command, timeout)
+        while True:
+            try:
+                # Timing out cancels the attempt, which stops retransmitting
+                # it, so only the next attempt is in flight.
+                _, res = await asyncio.wait_for(
+                    self._get_response(msg.copy()), attempts.timeout
+                )
+                attempts.succeeded()
+                return res
+            except asyncio.TimeoutError:
+                delay = attempts.failed(RequestTimeout("Request timed out."))
+            except RequestError as err:
+                delay = attempts.failed(err)
+            await asyncio.sleep(delay)
+
+    async def _execute(self, api_command, timeout=None):
         """Execute the command."""
         if api_command.observe:
             await self._observe(api_command)
@@ -148,57 +289,141 @@ class APIFactory:
 
         _LOGGER.debug("Executing %s %s", self._host, api_command)
 
+        self._breakers.before(api_command)
         try:
-            _, res = await self._get_response(msg)
+            res = await self._get_response_retrying(api_command, msg, timeout)
+            api_command.result = _process_output(res, parse_json)
+        except RequestError as err:
+            self._breakers.after(api_command, err)
+            raise
         except LibraryShutdown:
+            self._breakers.cancel(api_command)
             _LOGGER.warning(
                 "Protocol is shutdown, cancelling command: %s %s",
                 self._host,
                 api_command,
             )
             return None
-
-        api_command.result = _process_output(res, parse_json)
+        except BaseException:
+            self._breakers.cancel(api_command)
+            raise
+        self._breakers.after(api_command)
 
         return api_command.result
 
-    async def request(self, api_commands):
-        """Make a request."""
+    async def request(self, api_commands, *, timeout=None):
+        """Make a request. Timeout is in seconds, per command."""
         if not isinstance(api_commands, list):
-            result = await self._execute(api_commands)
+            result = await self._execute(api_commands, timeout)
             return result
 
-        commands = (self._execute(api_command) for api_command in api_commands)
+        commands = (
+            self._execute(api_command, timeout) for api_command in api_commands
+        )
         command_results = await asyncio.gather(*commands)
 
         return command_results
 
     async def _observe(self, api_command):
-        """Observe an endpoint."""
+        """Observe an endpoint.
+
+        The observation survives protocol resets, it is re-established on the
+        new protocol for the rest of its duration.
+        """
         duration = api_command.observe_duration
+        expires_at = monotonic() + duration if duration > 0 else None
+        observation = _Observation(api_command, expires_at)
+        await self._start_observation(observation)
+        if not observation.stopped:
+            self._observations.add(observation)
+
+    async def _start_observation(self, observation):
+        api_command = observation.api_command
         url = api_command.url(self._host)
-        err_callback = api_command.err_callback
 
-        msg = Message(code=Code.GET, uri=url, observe=duration)
+        msg = Message(code=Code.GET, uri=url, observe=api_command.observe_duration)
 
         # Note that this is necessary to start observing
         pr, r = await self._get_response(msg)
 
-        api_command.result = _process_output(r)
+        ob = pr.observation
+
+        try:
+            api_command.result = _process_output(r)
+        except StopObserving:
+            ob.cancel()
+            self._cancel_observation(observation)
+            return
 
         def success_callback(res):
-            api_command.result = _process_output(res)
+            if ob is observation.observation:
+                try:
+                    api_command.result = _process_output(res)
+                except StopObserving:
+                    self._cancel_observation(observation)
 
         def error_callback(ex):
             if isinstance(ex, LibraryShutdown):
                 _LOGGER.debug("Protocol is shutdown, stopping observation")
                 return
-            err_callback(ex)
+            if ob is not observation.observation:
+                # Replaced after a reset or stopped already.
+                return
+            self._stop_observation(observation, ex)
 
-        ob = pr.observation
+        observation.observation = ob
         ob.register_callback(success_callback)
         ob.register_errback(error_callback)
-        self._observations_err_callbacks.append(ob.error)
+
+        remaining = observation.remaining
+        if remaining is not None:
+            observation.timer = asyncio.get_event_loop().call_later(
+                remaining, self._expire_observation, observation
+            )
+
+    def _cancel_observation(self, observation):
+        """Stop the observation as its callback asked."""
+        observation.stop()
+        self._observations.discard(observation)
+
+    def _stop_observation(self, observation, err):
+        """Stop the observation and tell its caller why."""
+        if observation.stopped:
+            return
+        observation.stop()
+        self._observations.discard(observation)
+        observation.api_command.err_callback(err)
+
+    def _expire_observation(self, observation):
+        """Stop observing after duration, like coap-client does."""
+        if self._shutdown:
+            return
+        api_command = observation.api_command
+        _LOGGER.debug(
+            "Observing stopped for %s after %ss",
+            api_command.path_str,
+            api_command.observe_duration,
+        )
+        self._stop_observation(observation, RequestError("Observing stopped."))
+
+    async def _resubscribe(self, observations):
+        """Re-establish observations on a new protocol."""
+        _LOGGER.debug("Re-establishing %d observations", len(observations))
+        for observation in observations:
+            if observation.stopped or self._shutdown:
+                continue
+
+            remaining = observation.remaining
+            if remaining is not None and remaining < MIN_RESUBSCRIBE_DURATION:
+                self._stop_observation(observation, RequestError("Observing stopped."))
+                continue
+
+            try:
+                await self._start_observation(observation)
+            except RequestError as err:
+                self._stop_observation(observation, err)
+            except LibraryShutdown:
+                return
 
     async def generate_psk(self, security_key):
         """Generate and set a psk from the security key."""
@@ -242,22 +467,30 @@ class APIFactory:
 
 
 def _process_output(res, parse_json=True):
-    """Process output."""
-    res_payload = res.payload.decode("utf-8")
-    output = res_payload.strip()
-
-    _LOGGER.debug("Status: %s, Received: %s", res.code, output)
+    """Process output.
+
+    The payload is parsed as bytes, it is only decoded to a str when that is
+    needed, e.g. for debug logging or errors.
+    """
+    payload = res.payload
+
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        _LOGGER.debug(
+            "Status: %s, Received: %s",
+            res.code,
+            payload.decode("utf-8", "replace").strip(),
+        )
 
-    if not output:
+    if not payload or payload.isspace():
         return None
 
     if not res.code.is_successful():
         if 128 <= res.code < 160:
-            raise ClientError(output)
+            raise ClientError(payload.decode("utf-8", "replace").strip())
         elif 160 <= res.code < 192:
-            raise ServerError(output)
+            raise ServerError(payload.decode("utf-8", "replace").strip())
 
     if not parse_json:
-        return output
+        return payload.decode("utf-8").strip()
 
-    return json.loads(output)
+    return loads(payload)
@@ -0,0 +1,208 @@
+"""Circuit breakers failing fast on unreachable devices and gateways."""
+import logging
+import threading
+from time import monotonic
+
+from ..const import ROOT_DEVICES
+from ..error import CircuitOpenError, RequestTimeout, ServerError
+
+_LOGGER = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# Errors showing the device or gateway did not answer. A client error is an
+# answer, so it does not count.
+FAILURE_ERRORS = (RequestTimeout, ServerError)
+
+
+class CircuitBreaker:
+    """Track the failures of one device or gateway.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    commands fail fast. After `reset_timeout` seconds a single probe command
+    is let through (half open): if it succeeds the circuit closes, otherwise
+    it opens again.
+    """
+
+    def __init__(self, name, *, failure_threshold=3, reset_timeout=30):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout  # seconds
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return STATE_CLOSED
+        if self._probing or monotonic() - self._opened_at >= self._reset_timeout:
+            return STATE_HALF_OPEN
+        return STATE_OPEN
+
+    def allow(self):
+        """Return True if a command may be sent."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or monotonic() - self._opened_at < self._reset_timeout:
+                return False
+            self._probing = True
+            _LOGGER.debug("Probing %s", self.name)
+            return True
+
+    def cancel_probe(self):
+        """Let the next command probe instead, this one wasn't sent."""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                _LOGGER.info("Circuit of %s closed", self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self._failure_threshold:
+                if self._opened_at is None:
+                    _LOGGER.warning(
+                        "Circuit of %s opened after %d failures",
+                        self.name,
+                        self._failures,
+                    )
+                self._opened_at = monotonic()
+                self._probing = False
+
+    def record_probe_failure(self):
+        """Open the circuit again if a probe is running, otherwise do nothing."""
+        with self._lock:
+            if self._probing:
+                self._failures += 1
+                self._opened_at = monotonic()
+                self._probing = False
+
+    def trip(self):
+        """Open the circuit, e.g. when the device is known to be unreachable."""
+        with self._lock:
+            if self._opened_at is None:
+                _LOGGER.info("Circuit of %s opened", self.name)
+            self._failures = max(self._failures, self._failure_threshold)
+            self._opened_at = monotonic()
+            self._probing = False
+
+    def __repr__(self):
+        return "<CircuitBreaker {} {}>".format(self.name, self.state)
+
+
+class CircuitBreakers:
+    """Circuit breakers of a gateway and each of its devices.
+
+    Failures of device commands count towards the breaker of the device, so
+    one unplugged bulb doesn't open the circuit of the whole gateway. Other
+    failures count towards the gateway, which opens after
+    `gateway_failure_threshold` consecutive failures. A failed device command
+    that probed the gateway opens the circuit of the gateway again.
+    """
+
+    def __init__(
+        self,
+        host,
+        *,
+        failure_threshold=3,
+        gateway_failure_threshold=10,
+        reset_timeout=30,
+    ):
+        self._host = host
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout  # seconds
+        self._gateway = CircuitBreaker(
+            host,
+            failure_threshold=gateway_failure_threshold,
+            reset_timeout=reset_timeout,
+        )
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    @property
+    def gateway(self):
+        return self._gateway
+
+    def device(self, device_id):
+        """Return the breaker of the device, creating it if needed."""
+        key = str(device_id)
+        breaker = self._devices.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self._devices.setdefault(
+                    key,
+                    CircuitBreaker(
+                        "{} device {}".format(self._host, key),
+                        failure_threshold=self._failure_threshold,
+                        reset_timeout=self._reset_timeout,
+                    ),
+                )
+        return breaker
+
+    def _breakers(self, api_command):
+        path = api_command.path
+        if len(path) > 1 and path[0] == ROOT_DEVICES:
+            return self.device(path[1]), self._gateway
+        return None, self._gateway
+
+    def before(self, api_command):
+        """Raise CircuitOpenError if the command has to fail fast."""
+        device, gateway = self._breakers(api_command)
+        if device is not None and not device.allow():
+            raise CircuitOpenError(
+                "Device {} is not answering.".format(api_command.path[1])
+            )
+        if not gateway.allow():
+            if device is not None:
+                device.cancel_probe()
+            raise CircuitOpenError("Gateway {} is not answering.".format(self._host))
+
+    def after(self, api_command, err=None):
+        """Record the outcome of a sent command."""
+        device, gateway = self._breakers(api_command)
+        if err is None or not isinstance(err, FAILURE_ERRORS):
+            if device is not None:
+                device.record_success()
+            gateway.record_success()
+        elif device is not None:
+            device.record_failure()
+            # The command may have been the probe of the gateway too, which
+            # didn't get an answer either.
+            gateway.record_probe_failure()
+        else:
+            gateway.record_failure()
+
+    def cancel(self, api_command):
+        """Record that a command allowed by `before` wasn't sent after all."""
+        device, gateway = self._breakers(api_command)
+        if device is not None:
+            device.cancel_probe()
+        gateway.cancel_probe()
+
+    def update_device(self, device):
+        """Open or close the circuit of a device as reported by the gateway."""
+        breaker = self.device(device.id)
+        if device.reachable:
+            breaker.record_success()
+        else:
+            breaker.trip()
+
+    def open_circuits(self):
+        """Return the state of the breakers that aren't closed by name."""
+        breakers = [self._gateway] + list(self._devices.values())
+        return {
+            breaker.name: breaker.state
+            for breaker in breakers
+            if breaker.state != STATE_CLOSED
+        }
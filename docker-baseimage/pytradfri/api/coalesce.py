@@ -0,0 +1,153 @@
+"""Write-combining queue merging pending commands for the same resource."""
+import logging
+import threading
+from concurrent.futures import CancelledError, Future
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _leaf_keys(data, prefix=()):
+    """Return the paths of all values set by command data."""
+    if isinstance(data, dict):
+        keys = set()
+        for key, value in data.items():
+            keys |= _leaf_keys(value, prefix + (key,))
+        return keys
+    if isinstance(data, list) and len(data) == 1 and isinstance(data[0], dict):
+        return _leaf_keys(data[0], prefix)
+    return {prefix}
+
+
+class _Pending:
+    """A command waiting to be sent and the futures waiting for it."""
+
+    def __init__(self, command, combine):
+        self.command = command
+        self.combine = combine
+        self.keys = _leaf_keys(command.data)
+        self.futures = []
+
+    def merge(self, command, combine):
+        """Merge command into this one. Returns False if not possible."""
+        keys = _leaf_keys(command.data)
+
+        if keys == self.keys:
+            # Same values are set, only the latest state has to be sent.
+            self.command = command
+        elif combine and self.combine:
+            self.command = self.command + command
+            self.keys |= keys
+        else:
+            return False
+        return True
+
+
+class CommandCoalescer:
+    """Write-combining queue in front of a command scheduler.
+
+    PUT commands submitted for the same path within `flush_interval` seconds
+    are merged, so only the latest state is sent to the gateway. Commands
+    setting different values are only merged when `combine` is set (see
+    `LightControl.can_combine_commands`), otherwise they are sent in order.
+
+    `submit` queues a command without blocking and returns a Future for its
+    result, e.g. `CommandScheduler.submit`. Merged commands of different
+    paths are handed over at once, so they are sent concurrently.
+    """
+
+    def __init__(self, submit, flush_interval=0.1):
+        self._submit = submit
+        self._flush_interval = flush_interval  # seconds
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="pytradfri-coalesce", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, api_command, *, combine=False):
+        """Queue a command. Returns a Future for the result."""
+        future = Future()
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Coalescer has been closed.")
+
+            if api_command.method != "put" or api_command.observe:
+                # Only writes are safe to merge.
+                key = id(api_command)
+            else:
+                key = api_command.path_str
+
+            queue = self._pending.setdefault(key, [])
+            if not queue or not queue[-1].merge(api_command, combine):
+                queue.append(_Pending(api_command, combine))
+            queue[-1].futures.append(future)
+            self._condition.notify()
+
+        return future
+
+    def request(self, api_command, *, combine=False, timeout=None):
+        """Queue a command and wait for its result."""
+        return self.submit(api_command, combine=combine).result(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed and not self._pending:
+                    return
+
+                # Give the queue some time to collect commands to merge.
+                self._condition.wait_for(lambda: self._closed, self._flush_interval)
+                pending, self._pending = self._pending, {}
+
+            self._flush(pending)
+
+    def _flush(self, pending):
+        items = [item for path_items in pending.values() for item in path_items]
+        _LOGGER.debug(
+            "Flushing %d commands merged from %d",
+            len(items),
+            sum(len(item.futures) for item in items),
+        )
+
+        for path_items in pending.values():
+            self._send(path_items, 0)
+
+    def _send(self, items, index):
+        """Send items[index], the next item of the path once it is done."""
+        item = items[index]
+        try:
+            future = self._submit(item.command)
+        except Exception as err:  # pylint: disable=broad-except
+            self._resolve(items, index, None, err)
+            return
+
+        def done(future):
+            if future.cancelled():
+                self._resolve(items, index, None, CancelledError())
+            elif future.exception() is not None:
+                self._resolve(items, index, None, future.exception())
+            else:
+                self._resolve(items, index, future.result(), None)
+
+        future.add_done_callback(done)
+
+    def _resolve(self, items, index, result, err):
+        for future in items[index].futures:
+            if err is not None:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+        if index + 1 < len(items):
+            self._send(items, index + 1)
+
+    def close(self):
+        """Hand all pending commands over and stop."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
@@ -1,30 +1,77 @@
 """Coap implementation."""
 import json
 import logging
+import os
+import re
+import selectors
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from time import time
-
-from ..error import RequestError, RequestTimeout, ClientError, ServerError
+from time import sleep, time
+
+from ..error import (
+    BatchError,
+    RequestError,
+    RequestTimeout,
+    ClientError,
+    ServerError,
+    StopObserving,
+)
 from ..gateway import Gateway
+from ..util import loads
+from .breaker import CircuitBreakers
+from .retry import Attempts, LatencyTracker, RetryPolicy
 
 _LOGGER = logging.getLogger(__name__)
 
-CLIENT_ERROR_PREFIX = "4."
-SERVER_ERROR_PREFIX = "5."
+CLIENT_ERROR_PREFIX = b"4."
+SERVER_ERROR_PREFIX = b"5."
 
 
 class APIFactory:
-    def __init__(self, host, psk_id="pytradfri", psk=None, timeout=10):
+    def __init__(
+        self,
+        host,
+        psk_id="pytradfri",
+        psk=None,
+        timeout=10,
+        *,
+        max_workers=1,
+        retry_policy=None,
+        breakers=None,
+    ):
+        if max_workers < 1:
+            raise ValueError("Max workers has to be at least 1.")
+
         self._host = host
         self._psk_id = psk_id
         self._psk = psk
         self._timeout = timeout  # seconds
+        # Timeouts are learned from the gateway, `timeout` bounds all
+        # attempts of a request together.
+        self._retry_policy = retry_policy or RetryPolicy(
+            latency=LatencyTracker(max_timeout=timeout), deadline=timeout
+        )
+        self._breakers = breakers or CircuitBreakers(host)
+        self._observations = None
+        # Width of the pool lists of commands are executed on.
+        self._max_workers = max_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
     @property
     def psk(self):
         return self._psk
 
+    @property
+    def retry_policy(self):
+        return self._retry_policy
+
+    @property
+    def breakers(self):
+        return self._breakers
+
     @psk.setter
     def psk(self, value):
         self._psk = value
@@ -44,32 +91,57 @@ class APIFactory:
         ]
 
     def _execute(self, api_command, *, timeout=None):
-        """Execute the command."""
+        """Execute the command.
+
+        Fails fast with CircuitOpenError while the device or gateway isn't
+        answering.
+        """
 
         if api_command.observe:
             self._observe(api_command)
             return
 
+        self._breakers.before(api_command)
+        try:
+            result = self._send_retrying(api_command, timeout=timeout)
+        except RequestError as err:
+            self._breakers.after(api_command, err)
+            raise
+        except BaseException:
+            self._breakers.cancel(api_command)
+            raise
+        self._breakers.after(api_command)
+        return result
+
+    def _send_retrying(self, api_command, *, timeout):
+        """Execute the command, retrying as the retry policy allows."""
+        attempts = Attempts(self._retry_policy, api_command, timeout)
+        while True:
+            try:
+                result = self._send(api_command, timeout=attempts.timeout)
+            except RequestError as err:
+                sleep(attempts.failed(err))
+                continue
+            attempts.succeeded()
+            return result
+
+    def _send(self, api_command, *, timeout):
+        """Execute the command once."""
         method = api_command.method
         path = api_command.path
         data = api_command.data
         parse_json = api_command.parse_json
         url = api_command.url(self._host)
 
-        proc_timeout = self._timeout
-        if timeout is not None:
-            proc_timeout = timeout
-
         command = self._base_command(method)
 
         kwargs = {
             "stderr": subprocess.DEVNULL,
-            "timeout": proc_timeout,
-            "universal_newlines": True,
+            "timeout": timeout,
         }
 
         if data is not None:
-            kwargs["input"] = json.dumps(data)
+            kwargs["input"] = json.dumps(data).encode("utf-8")
             command.append("-f")
             command.append("-")
             _LOGGER.debug("Executing %s %s %s: %s", self._host, method, path, data)
@@ -89,26 +161,55 @@ class APIFactory:
         return api_command.result
 
     def request(self, api_commands, *, timeout=None):
-        """Make a request. Timeout is in seconds."""
+        """Make a request. Timeout is in seconds.
+
+        A list of commands is executed on up to `max_workers` coap-client
+        processes at once. The results are returned in order. If any command
+        fails, the others still run and a BatchError is raised afterwards.
+        """
         if not isinstance(api_commands, list):
             return self._execute(api_commands, timeout=timeout)
 
-        command_results = []
+        def execute(api_command):
+            try:
+                return self._execute(api_command, timeout=timeout), None
+            except RequestError as err:
+                return None, err
+
+        if self._max_workers == 1 or len(api_commands) < 2:
+            outcomes = [execute(api_command) for api_command in api_commands]
+        else:
+            outcomes = list(self._get_executor().map(execute, api_commands))
 
-        for api_command in api_commands:
-            result = self._execute(api_command, timeout=timeout)
-            command_results.append(result)
+        command_results = [result for result, _ in outcomes]
+        errors = {i: err for i, (_, err) in enumerate(outcomes) if err is not None}
+        if errors:
+            raise BatchError(command_results, errors)
 
         return command_results
 
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_workers,
+                    thread_name_prefix="pytradfri-{}".format(self._host),
+                )
+            return self._executor
+
+    def close(self):
+        """Stop the pool commands are executed on."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
     def _observe(self, api_command):
         """Observe an endpoint."""
-        path = api_command.path
         duration = api_command.observe_duration
         if duration <= 0:
             raise ValueError("Observation duration has to be greater than 0.")
         url = api_command.url(self._host)
-        err_callback = api_command.err_callback
 
         command = self._base_command("get") + [
             "-s",
@@ -121,35 +222,17 @@ class APIFactory:
         kwargs = {
             "stdout": subprocess.PIPE,
             "stderr": subprocess.DEVNULL,
-            "universal_newlines": True,
         }
         try:
             proc = subprocess.Popen(command, **kwargs)
-        except subprocess.CalledProcessError as err:
+        except (OSError, subprocess.SubprocessError) as err:
             raise RequestError("Error executing request: {}".format(err)) from None
 
-        output = ""
-        open_obj = 0
-        start = time()
-
-        for data in iter(lambda: proc.stdout.read(1), ""):
-            if data == "\n":
-                _LOGGER.debug(
-                    "Observing stopped for %s after %.1fs", path, time() - start
-                )
-                err_callback(RequestError("Observing stopped."))
-                break
-
-            if data == "{":
-                open_obj += 1
-            elif data == "}":
-                open_obj -= 1
-
-            output += data
-
-            if open_obj == 0:
-                api_command.result = _process_output(output)
-                output = ""
+        # The output of all observations is read by a single thread, so
+        # observing returns as soon as the process is started.
+        if self._observations is None:
+            self._observations = _ObservationMultiplexer()
+        self._observations.add(proc, api_command)
 
     def generate_psk(self, security_key):
         """
@@ -172,31 +255,177 @@ class APIFactory:
         return self._psk
 
 
+class _JsonStreamDecoder:
+    """Split the output of coap-client into the JSON objects it observed.
+
+    coap-client prints the observed objects back to back and a newline when
+    observing stops. Braces inside JSON strings are handled correctly.
+    """
+
+    _SPECIAL = re.compile(rb'[{}"\\\n]')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self.stopped = False
+
+    def feed(self, data):
+        """Add a chunk of output. Returns the complete objects in it."""
+        self._buffer += data
+        objects = []
+        start = 0
+        buffer = self._buffer
+
+        while not self.stopped:
+            match = self._SPECIAL.search(buffer, self._pos)
+            if match is None:
+                self._pos = len(buffer)
+                break
+
+            char = match.group()
+            self._pos = match.end()
+
+            if self._in_string:
+                if char == b"\\":
+                    # Skip the escaped character.
+                    if self._pos == len(buffer):
+                        self._pos -= 1
+                        break
+                    self._pos += 1
+                elif char == b'"':
+                    self._in_string = False
+            elif char == b'"':
+                self._in_string = True
+            elif char == b"{":
+                if self._depth == 0:
+                    start = match.start()
+                self._depth += 1
+            elif char == b"}":
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.append(bytes(buffer[start : self._pos]))
+                    start = self._pos
+            elif char == b"\n" and self._depth == 0:
+                self.stopped = True
+
+        if self._depth == 0:
+            # Anything before the next object is not part of an object.
+            start = self._pos
+        del buffer[:start]
+        self._pos -= start
+        return objects
+
+
+class _ObservationMultiplexer:
+    """Read the output of all observing coap-client processes in one thread."""
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        self._thread = threading.Thread(
+            target=self._run, name="pytradfri-observe", daemon=True
+        )
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._selector.get_map()) - 1
+
+    def add(self, proc, api_command):
+        """Start reading the output of an observing process."""
+        with self._lock:
+            self._pending.append((proc, api_command, time()))
+        os.write(self._wakeup_write, b"\0")
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.fileobj == self._wakeup_read:
+                    os.read(self._wakeup_read, 4096)
+                    self._register_pending()
+                else:
+                    self._read(key)
+
+    def _register_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for proc, api_command, start in pending:
+            self._selector.register(
+                proc.stdout,
+                selectors.EVENT_READ,
+                (proc, api_command, start, _JsonStreamDecoder()),
+            )
+
+    def _read(self, key):
+        proc, api_command, start, decoder = key.data
+        data = os.read(key.fd, 65536)
+
+        cancelled = False
+        for output in decoder.feed(data):
+            try:
+                api_command.result = _process_output(output)
+            except StopObserving:
+                cancelled = True
+                break
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Error processing observation of %s", api_command)
+
+        if data and not decoder.stopped and not cancelled:
+            return
+
+        self._selector.unregister(key.fileobj)
+        proc.stdout.close()
+        if proc.poll() is None:
+            # Don't block the other observations on a lingering process.
+            proc.terminate()
+        proc.wait()
+        _LOGGER.debug(
+            "Observing stopped for %s after %.1fs", api_command.path, time() - start
+        )
+        if cancelled:
+            return
+        try:
+            api_command.err_callback(RequestError("Observing stopped."))
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Error in observation callback of %s", api_command)
+
+
 def _process_output(output, parse_json=True):
-    """Process output."""
-    output = output.strip()
-    _LOGGER.debug("Received: %s", output)
+    """Process output.
+
+    The output is parsed as bytes, it is only decoded to a str when that is
+    needed, e.g. for debug logging or errors.
+    """
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        _LOGGER.debug("Received: %s", output.decode("utf-8", "replace").strip())
 
-    if not output:
+    if not output or output.isspace():
         return None
 
-    elif "decrypt_verify" in output:
+    # Only look at the start of the output instead of stripping a copy of it.
+    head = output[:16].lstrip()
+
+    if b"decrypt_verify" in output:
         raise RequestError(
             "Please compile coap-client without debug output. See "
             "instructions at "
             "https://github.com/ggravlingen/pytradfri#installation"
         )
 
-    elif output.startswith(CLIENT_ERROR_PREFIX):
-        raise ClientError(output)
+    elif head.startswith(CLIENT_ERROR_PREFIX):
+        raise ClientError(output.decode("utf-8", "replace").strip())
 
-    elif output.startswith(SERVER_ERROR_PREFIX):
-        raise ServerError(output)
+    elif head.startswith(SERVER_ERROR_PREFIX):
+        raise ServerError(output.decode("utf-8", "replace").strip())
 
     elif not parse_json:
-        return output
+        return output.decode("utf-8").strip()
 
-    return json.loads(output)
+    return loads(output)
 
 
 def retry_timeout(api, retries=3):
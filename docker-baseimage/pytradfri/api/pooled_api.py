@@ -0,0 +1,296 @@
+"""Synchronous COAP implementation using a pool of persistent DTLS sessions."""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from time import monotonic
+
+from ..error import RequestError, RequestTimeout
+from ..gateway import Gateway
+from .aiocoap_api import APIFactory as AsyncAPIFactory
+from .breaker import CircuitBreakers
+from .retry import LatencyTracker, RetryPolicy
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds the caller waits beyond the request timeout, so the session loop
+# times the request out itself and the retry policy and circuit breakers see
+# the timeout.
+REQUEST_TIMEOUT_GRACE = 2
+
+
+class _Session:
+    """A single DTLS session to the gateway."""
+
+    def __init__(self, index):
+        self.index = index
+        self.factory = None
+        self.lock = None
+        self.in_flight = 0
+        self.last_used = monotonic()
+        self.last_checked = monotonic()
+
+    @property
+    def is_open(self):
+        return self.factory is not None
+
+    @property
+    def observations(self):
+        """Number of running observations, they keep the session open."""
+        return 0 if self.factory is None else self.factory.observations
+
+    def __repr__(self):
+        return "<Session #{} open: {}, in flight: {}, observations: {}>".format(
+            self.index, self.is_open, self.in_flight, self.observations
+        )
+
+
+class APIFactory:
+    """Drop-in replacement for the libcoap APIFactory.
+
+    Instead of forking a coap-client process and performing a full DTLS
+    handshake per command, commands are multiplexed over a pool of
+    authenticated aiocoap sessions that are kept open between requests.
+    The sessions live on an event loop in a background thread, so `request`
+    can be called from any (e.g. Flask worker) thread.
+    """
+
+    def __init__(
+        self,
+        host,
+        psk_id="pytradfri",
+        psk=None,
+        timeout=10,
+        *,
+        pool_size=1,
+        idle_timeout=300,
+        health_check_interval=60,
+        retry_policy=None,
+        breakers=None,
+    ):
+        if pool_size < 1:
+            raise ValueError("Pool size has to be at least 1.")
+
+        self._host = host
+        self._psk_id = psk_id
+        self._psk = psk
+        self._timeout = timeout  # seconds
+        # Shared by all sessions, they talk to the same gateway.
+        self._retry_policy = retry_policy or RetryPolicy(
+            latency=LatencyTracker(max_timeout=timeout), deadline=timeout
+        )
+        self._breakers = breakers or CircuitBreakers(host)
+        self._idle_timeout = idle_timeout  # seconds, None to never expire
+        self._health_check_interval = health_check_interval  # seconds
+        self._sessions = [_Session(i) for i in range(pool_size)]
+        self._closed = False
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever,
+            name="pytradfri-{}".format(host),
+            daemon=True,
+        )
+        self._thread.start()
+        self._maintenance = self._run(self._maintain())
+
+    @property
+    def psk(self):
+        return self._psk
+
+    @psk.setter
+    def psk(self, value):
+        self._psk = value
+
+    @property
+    def retry_policy(self):
+        return self._retry_policy
+
+    @property
+    def breakers(self):
+        return self._breakers
+
+    @property
+    def loop(self):
+        """Event loop the sessions are running on."""
+        return self._loop
+
+    @property
+    def sessions(self):
+        return list(self._sessions)
+
+    def _run(self, coro):
+        """Schedule a coroutine on the session loop."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def _acquire(self):
+        """Return the session with the least commands in flight."""
+        session = min(self._sessions, key=lambda s: (s.in_flight, not s.is_open))
+        session.in_flight += 1
+        session.last_used = monotonic()
+        return session
+
+    def _release(self, session):
+        session.in_flight -= 1
+        session.last_used = monotonic()
+
+    async def _open(self, session):
+        """Open the session if it is not open already."""
+        if session.lock is None:
+            # Created lazily so the lock is bound to the session loop.
+            session.lock = asyncio.Lock()
+
+        async with session.lock:
+            if session.factory is None:
+                _LOGGER.debug("Opening session #%d to %s", session.index, self._host)
+                session.factory = await AsyncAPIFactory.init(
+                    self._host,
+                    psk_id=self._psk_id,
+                    psk=self._psk,
+                    retry_policy=self._retry_policy,
+                    breakers=self._breakers,
+                )
+                session.last_checked = monotonic()
+        return session.factory
+
+    async def _close(self, session):
+        """Close the session, it is reopened on next use."""
+        factory = session.factory
+        if factory is None:
+            return
+        _LOGGER.debug("Closing session #%d to %s", session.index, self._host)
+        session.factory = None
+        # Tells the callers of its observations, so they can resubscribe.
+        await factory.shutdown()
+
+    async def _execute(self, api_command, timeout):
+        """Execute a single command on a pooled session."""
+        session = self._acquire()
+        try:
+            factory = await self._open(session)
+            result = await factory.request(api_command, timeout=timeout)
+        finally:
+            self._release(session)
+        return result
+
+    async def _request(self, api_commands, timeout):
+        if not isinstance(api_commands, list):
+            return await self._execute(api_commands, timeout)
+
+        commands = (
+            self._execute(api_command, timeout) for api_command in api_commands
+        )
+        return await asyncio.gather(*commands)
+
+    def request(self, api_commands, *, timeout=None):
+        """Make a request. Timeout is in seconds.
+
+        The timeout bounds all attempts of each command, the session loop
+        raises RequestTimeout when it expires.
+        """
+        if self._closed:
+            raise RequestError("API factory has been closed.")
+
+        request_timeout = self._timeout
+        if timeout is not None:
+            request_timeout = timeout
+
+        future = self._run(self._request(api_commands, request_timeout))
+        try:
+            # Only a safety net, e.g. when opening the session hangs.
+            return future.result(request_timeout + REQUEST_TIMEOUT_GRACE)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            # Cancelling doesn't count as a failure in the session loop.
+            err = RequestTimeout()
+            commands = api_commands
+            if not isinstance(api_commands, list):
+                commands = [api_commands]
+            for api_command in commands:
+                if not api_command.observe:
+                    self._breakers.after(api_command, err)
+            raise err from None
+
+    async def _check_health(self, session):
+        """Probe an idle session, closing it if the gateway does not answer."""
+        session.last_checked = monotonic()
+        session.in_flight += 1
+        try:
+            await asyncio.wait_for(
+                session.factory.request(Gateway().get_gateway_info()), self._timeout
+            )
+        except (RequestError, asyncio.TimeoutError) as err:
+            _LOGGER.warning(
+                "Health check of session #%d to %s failed: %s",
+                session.index,
+                self._host,
+                err,
+            )
+            await self._close(session)
+        finally:
+            session.in_flight -= 1
+
+    async def _maintain(self):
+        """Expire idle sessions and health check the open ones."""
+        intervals = [
+            i for i in (self._idle_timeout, self._health_check_interval) if i
+        ]
+        if not intervals:
+            return
+        interval = min(intervals) / 2
+
+        while True:
+            await asyncio.sleep(interval)
+            now = monotonic()
+
+            for session in self._sessions:
+                if not session.is_open or session.in_flight:
+                    continue
+
+                idle = now - session.last_used
+                if (
+                    self._idle_timeout
+                    and not session.observations
+                    and idle > self._idle_timeout
+                ):
+                    await self._close(session)
+                elif (
+                    self._health_check_interval
+                    and idle > self._health_check_interval
+                    and now - session.last_checked > self._health_check_interval
+                ):
+                    await self._check_health(session)
+
+    def close(self):
+        """Close all sessions and stop the session loop."""
+        if self._closed:
+            return
+        self._closed = True
+
+        async def close_sessions():
+            self._maintenance.cancel()
+            for session in self._sessions:
+                await self._close(session)
+
+        try:
+            self._run(close_sessions()).result(self._timeout)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(self._timeout)
+
+    def generate_psk(self, security_key):
+        """
+        Generate and set a psk from the security key.
+        """
+        if not self._psk:
+
+            async def generate():
+                factory = await AsyncAPIFactory.init(self._host, psk_id=self._psk_id)
+                try:
+                    return await factory.generate_psk(security_key)
+                finally:
+                    await factory.shutdown()
+
+            self._psk = self._run(generate()).result(self._timeout)
+
+        return self._psk
@@ -0,0 +1,249 @@
+"""Adaptive timeouts and retries shared by the API backends."""
+from collections import deque
+import logging
+import random
+import threading
+from time import monotonic
+
+from ..error import ClientError, RequestError
+
+_LOGGER = logging.getLogger(__name__)
+
+# Sending these again has the same effect as sending them once. A PUT sets
+# absolute values, also when the coalescer merged several of them.
+IDEMPOTENT_METHODS = frozenset(("get", "put", "delete", "fetch"))
+
+
+def _percentile(samples, percentile):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+
+class LatencyTracker:
+    """Learn a timeout from the latencies of recent successful requests."""
+
+    def __init__(
+        self,
+        *,
+        initial_timeout=3,
+        min_timeout=1,
+        max_timeout=10,
+        percentile=0.99,
+        multiplier=3,
+        window=200,
+        min_samples=20,
+    ):
+        self._min_timeout = min_timeout  # seconds
+        self._max_timeout = max_timeout  # seconds
+        self._percentile = percentile
+        self._multiplier = multiplier
+        self._min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        # Below the maximum until enough latencies are known, so an
+        # unanswered first attempt leaves time to retry.
+        self._timeout = min(initial_timeout, max_timeout)  # seconds
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        """Current timeout in seconds."""
+        return self._timeout
+
+    @property
+    def min_timeout(self):
+        return self._min_timeout
+
+    @property
+    def max_timeout(self):
+        return self._max_timeout
+
+    def percentile(self, percentile):
+        """Return the given percentile of the recent latencies or None."""
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None
+        return _percentile(samples, percentile)
+
+    def record(self, latency):
+        """Record the latency of a successful request in seconds."""
+        with self._lock:
+            self._samples.append(latency)
+            if len(self._samples) < self._min_samples:
+                return
+            latency = _percentile(self._samples, self._percentile)
+            self._timeout = min(
+                self._max_timeout, max(self._min_timeout, latency * self._multiplier)
+            )
+
+
+class RetryBudget:
+    """Limit retries to a ratio of the requests made.
+
+    Every request deposits `ratio` tokens and every retry withdraws one, so
+    a gateway that stops answering gets a little more load, not a multiple
+    of it.
+    """
+
+    def __init__(self, ratio=0.2, max_tokens=10):
+        self._ratio = ratio
+        self._max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._max_tokens, self._tokens + self._ratio)
+
+    def withdraw(self):
+        """Take a token for a retry. Returns False if the budget is spent."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    """Decide how long to wait for a gateway and when to try again.
+
+    Timeouts are learned per gateway from the latencies of successful
+    requests and doubled for every retry. Failed requests are retried after
+    an exponential backoff with full jitter, as long as the command is
+    idempotent and the retry budget is not spent. Client errors are never
+    retried, the same request would fail again.
+
+    All attempts of a request, including the backoff in between, take at
+    most `deadline` seconds (None for no limit).
+    """
+
+    def __init__(
+        self,
+        *,
+        attempts=3,
+        base_delay=0.1,
+        max_delay=2,
+        latency=None,
+        budget=None,
+        deadline=None,
+    ):
+        if attempts < 1:
+            raise ValueError("Attempts has to be at least 1.")
+
+        self.attempts = attempts
+        self.deadline = deadline  # seconds
+        self._base_delay = base_delay  # seconds
+        self._max_delay = max_delay  # seconds
+        self.latency = latency or LatencyTracker()
+        self.budget = budget or RetryBudget()
+
+    def timeout(self, attempt=0):
+        """Return the timeout of the given attempt in seconds."""
+        return min(self.latency.timeout * 2 ** attempt, self.latency.max_timeout)
+
+    def record_request(self):
+        """Record that a new request is made."""
+        self.budget.deposit()
+
+    def record_success(self, latency):
+        """Record the latency of a successful attempt in seconds."""
+        self.latency.record(latency)
+
+    def backoff(self, attempt):
+        """Return the delay before the given retry in seconds."""
+        return random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+
+    def retry_delay(self, api_command, err, attempt):
+        """Return the delay before retrying a failed attempt, None to give up.
+
+        `attempt` is the number of the failed attempt, starting at 0.
+        """
+        if attempt + 1 >= self.attempts:
+            return None
+        if not isinstance(err, RequestError) or isinstance(err, ClientError):
+            return None
+        if api_command.method not in IDEMPOTENT_METHODS:
+            return None
+        if not self.budget.withdraw():
+            _LOGGER.debug("Retry budget spent, not retrying %s", api_command)
+            return None
+
+        delay = self.backoff(attempt)
+        _LOGGER.debug(
+            "Retrying %s in %.2fs after attempt %d failed: %s",
+            api_command,
+            delay,
+            attempt + 1,
+            err,
+        )
+        return delay
+
+
+class Attempts:
+    """Time the attempts of a single request.
+
+    Usage in a backend:
+
+        attempts = Attempts(policy, api_command)
+        while True:
+            try:
+                result = send(api_command, timeout=attempts.timeout)
+            except RequestError as err:
+                delay = attempts.failed(err)  # re-raises when giving up
+                sleep(delay)
+                continue
+            attempts.succeeded()
+            return result
+
+    `timeout` limits all attempts together in seconds, it defaults to the
+    deadline of the policy.
+    """
+
+    def __init__(self, policy, api_command, timeout=None):
+        self._policy = policy
+        self._api_command = api_command
+        self.attempt = 0
+        self._started = monotonic()
+        if timeout is None:
+            timeout = policy.deadline
+        self._deadline = None if timeout is None else self._started + timeout
+        policy.record_request()
+
+    @property
+    def remaining(self):
+        """Seconds left until the deadline, None if there is none."""
+        if self._deadline is None:
+            return None
+        return self._deadline - monotonic()
+
+    @property
+    def timeout(self):
+        """Timeout of the current attempt in seconds."""
+        timeout = self._policy.timeout(self.attempt)
+        remaining = self.remaining
+        if remaining is not None:
+            timeout = max(0, min(timeout, remaining))
+        return timeout
+
+    def succeeded(self):
+        self._policy.record_success(monotonic() - self._started)
+
+    def failed(self, err):
+        """Return the delay before the next attempt or re-raise err."""
+        delay = self._policy.retry_delay(self._api_command, err, self.attempt)
+        if delay is None:
+            raise err
+        remaining = self.remaining
+        if (
+            remaining is not None
+            and remaining - delay < self._policy.latency.min_timeout
+        ):
+            # Not enough time left for another attempt.
+            raise err
+        self.attempt += 1
+        self._started = monotonic() + delay
+        return delay
@@ -0,0 +1,211 @@
+"""Admission control for commands sent to a gateway."""
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import logging
+import threading
+from time import monotonic
+
+_LOGGER = logging.getLogger(__name__)
+
+# Lower values are sent first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_OBSERVE = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BULK: "bulk",
+    PRIORITY_OBSERVE: "observe",
+}
+
+
+class _Entry:
+    def __init__(self, api_command, future):
+        self.api_command = api_command
+        self.future = future
+        self.queued_at = monotonic()
+
+
+class _PriorityQueue:
+    """Commands of one priority, round robin across fairness keys."""
+
+    def __init__(self):
+        self._queues = OrderedDict()
+        self.depth = 0
+
+    def put(self, key, entry):
+        self._queues.setdefault(key, deque()).append(entry)
+        self.depth += 1
+
+    def get(self):
+        key, queue = self._queues.popitem(last=False)
+        entry = queue.popleft()
+        if queue:
+            # Move to the back so other keys are served first.
+            self._queues[key] = queue
+        self.depth -= 1
+        return entry
+
+
+class _Stats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self, depth):
+        return {
+            "queue_depth": depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "wait_mean": self.wait_total / self.sent if self.sent else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+class CommandScheduler:
+    """Rate limit and prioritize commands sent to a gateway.
+
+    At most `max_in_flight` commands are executed at once and at most `rate`
+    commands are started per second (allowing bursts of `burst`). Queued
+    commands are sent by priority and, within a priority, round robin across
+    fairness keys (e.g. group ids) so one busy group can't starve the others.
+    """
+
+    def __init__(self, request, *, max_in_flight=4, rate=20.0, burst=None):
+        if max_in_flight < 1:
+            raise ValueError("Max in flight has to be at least 1.")
+        if rate <= 0:
+            raise ValueError("Rate has to be greater than 0.")
+
+        self._request = request
+        self._rate = rate  # commands per second
+        self._burst = burst or max(1.0, rate)
+        self._tokens = self._burst
+        self._refilled_at = monotonic()
+        self._queues = {priority: _PriorityQueue() for priority in PRIORITY_NAMES}
+        self._stats = {priority: _Stats() for priority in PRIORITY_NAMES}
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._workers = [
+            threading.Thread(
+                target=self._work, name="pytradfri-scheduler-{}".format(i), daemon=True
+            )
+            for i in range(max_in_flight)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, api_command, *, priority=PRIORITY_INTERACTIVE, fairness_key=None):
+        """Queue a command. Returns a Future for the result."""
+        if priority not in self._queues:
+            raise ValueError("Unknown priority: {}".format(priority))
+
+        future = Future()
+        if fairness_key is None:
+            fairness_key = api_command.path_str
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Scheduler has been closed.")
+            self._queues[priority].put(fairness_key, _Entry(api_command, future))
+            self._condition.notify()
+
+        return future
+
+    def request(
+        self, api_commands, *, priority=PRIORITY_INTERACTIVE, fairness_key=None
+    ):
+        """Queue command(s) and wait for the result(s)."""
+        if not isinstance(api_commands, list):
+            return self.submit(
+                api_commands, priority=priority, fairness_key=fairness_key
+            ).result()
+
+        futures = [
+            self.submit(api_command, priority=priority, fairness_key=fairness_key)
+            for api_command in api_commands
+        ]
+        return [future.result() for future in futures]
+
+    def metrics(self):
+        """Return queue depth and wait times (in seconds) per priority."""
+        with self._condition:
+            metrics = {
+                PRIORITY_NAMES[priority]: stats.as_dict(self._queues[priority].depth)
+                for priority, stats in self._stats.items()
+            }
+            metrics["in_flight"] = self._in_flight
+            metrics["tokens"] = round(self._tokens, 2)
+        return metrics
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._refilled_at) * self._rate
+        )
+        self._refilled_at = now
+
+    def _next(self):
+        """Wait for a command that may be sent. Returns None when closed."""
+        with self._condition:
+            while True:
+                if self._closed:
+                    return None, None
+
+                priority = next(
+                    (p for p in sorted(self._queues) if self._queues[p].depth), None
+                )
+                if priority is None:
+                    self._condition.wait()
+                    continue
+
+                self._refill()
+                if self._tokens < 1:
+                    self._condition.wait((1 - self._tokens) / self._rate)
+                    continue
+
+                self._tokens -= 1
+                self._in_flight += 1
+                entry = self._queues[priority].get()
+
+                waited = monotonic() - entry.queued_at
+                stats = self._stats[priority]
+                stats.sent += 1
+                stats.wait_total += waited
+                stats.wait_max = max(stats.wait_max, waited)
+                return priority, entry
+
+    def _work(self):
+        while True:
+            priority, entry = self._next()
+            if entry is None:
+                return
+
+            if not entry.future.set_running_or_notify_cancel():
+                failed = False
+            else:
+                try:
+                    entry.future.set_result(self._request(entry.api_command))
+                    failed = False
+                except Exception as err:  # pylint: disable=broad-except
+                    entry.future.set_exception(err)
+                    failed = True
+
+            with self._condition:
+                self._in_flight -= 1
+                if failed:
+                    self._stats[priority].failed += 1
+
+    def close(self):
+        """Stop sending commands. Queued commands are cancelled."""
+        with self._condition:
+            self._closed = True
+            for queue in self._queues.values():
+                while queue.depth:
+                    queue.get().future.cancel()
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
@@ -0,0 +1,73 @@
+"""Capabilities of lights, detected once per model and firmware."""
+import threading
+
+from .color import supported_features
+from .const import (
+    ATTR_LIGHT_COLOR_HUE,
+    ATTR_LIGHT_COLOR_X,
+    ATTR_LIGHT_DIMMER,
+    ATTR_LIGHT_MIREDS,
+)
+
+
+class LightCapabilities:
+    """What the lights of a model support."""
+
+    __slots__ = (
+        "can_set_dimmer",
+        "can_set_temp",
+        "can_set_xy",
+        "can_set_color",
+        "can_combine_commands",
+        "supported_features",
+    )
+
+    def __init__(self, manufacturer, light_raw):
+        self.can_set_dimmer = True if ATTR_LIGHT_DIMMER in light_raw else None
+        self.can_set_temp = True if ATTR_LIGHT_MIREDS in light_raw else None
+        self.can_set_xy = True if ATTR_LIGHT_COLOR_X in light_raw else None
+        self.can_set_color = True if ATTR_LIGHT_COLOR_HUE in light_raw else None
+
+        # Currently uncertain which bulbs are capable of setting
+        # multiple values simultaneously. As of gateway firmware
+        # 1.3.14 1st party bulbs do not seem to support this properly,
+        # but (at least some) hue bulbs do.
+        self.can_combine_commands = (
+            True if manufacturer and "Philips" in manufacturer else None
+        )
+
+        self.supported_features = supported_features(light_raw)
+
+    def __repr__(self):
+        return "<LightCapabilities features: {}>".format(self.supported_features)
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def light_capabilities(
+    manufacturer, model_number, firmware_version, light_raw, *, reachable=True
+):
+    """Return the capabilities of a light, shared by all lights of the model.
+
+    A firmware update gives a new key, so the capabilities are detected
+    again. Unreachable lights may report incomplete state, so they are
+    detected but not cached.
+    """
+    key = (manufacturer, model_number, firmware_version)
+    capabilities = _cache.get(key)
+    if capabilities is not None:
+        return capabilities
+
+    capabilities = LightCapabilities(manufacturer, light_raw)
+    if reachable and model_number is not None and firmware_version is not None:
+        with _lock:
+            capabilities = _cache.setdefault(key, capabilities)
+    return capabilities
+
+
+def clear_cache():
+    """Forget all detected capabilities."""
+    with _lock:
+        _cache.clear()
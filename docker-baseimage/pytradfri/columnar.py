@@ -0,0 +1,148 @@
+"""Columnar view of the state of all devices of a gateway."""
+from array import array
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Stored for values the device doesn't report, e.g. the dimmer of a socket.
+MISSING = -1
+
+# Column name, array typecode, numpy dtype.
+_COLUMNS = (
+    ("present", "b", "int8"),
+    ("reachable", "b", "int8"),
+    ("is_light", "b", "int8"),
+    ("state", "b", "int8"),
+    ("dimmer", "h", "int16"),
+    ("mireds", "h", "int16"),
+)
+
+_INITIAL_CAPACITY = 64
+
+
+def _value(value):
+    return MISSING if value is None else value
+
+
+class FleetColumns:
+    """State of the first light of every device as one array per column.
+
+    Every device gets a stable index the first time it is seen. Removed
+    devices keep their index with `present` set to 0. The columns are NumPy
+    arrays when NumPy is installed and `array.array` otherwise, so
+    aggregates like the number of lights on don't walk Device objects.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = {}
+        self._device_ids = []
+        self._size = 0
+        if numpy is not None:
+            self._columns = {
+                name: numpy.full(_INITIAL_CAPACITY, MISSING, dtype=dtype)
+                for name, _, dtype in _COLUMNS
+            }
+        else:
+            self._columns = {name: array(typecode) for name, typecode, _ in _COLUMNS}
+
+    @property
+    def device_ids(self):
+        """Device ids by index."""
+        return list(self._device_ids)
+
+    def __len__(self):
+        return self._size
+
+    def index_of(self, device_id):
+        """Return the index of the device or None."""
+        return self._index.get(str(device_id))
+
+    def indices(self, device_ids):
+        """Return the indices of the known devices among device_ids."""
+        indices = (self._index.get(str(device_id)) for device_id in device_ids)
+        indices = [index for index in indices if index is not None]
+        if numpy is not None:
+            return numpy.array(indices, dtype="intp")
+        return indices
+
+    def column(self, name):
+        """Return a column, a view that is valid until the next new device."""
+        column = self._columns[name]
+        if numpy is not None:
+            return column[: self._size]
+        return column
+
+    def columns(self):
+        """Return all columns by name."""
+        return {name: self.column(name) for name, _, _ in _COLUMNS}
+
+    def update(self, device):
+        """Store the current state of the device."""
+        model = device.model
+        light = model.lights[0] if model.lights else None
+        row = (
+            1,
+            int(model.reachable),
+            int(light is not None),
+            int(light.state) if light is not None else MISSING,
+            _value(light.dimmer) if light is not None else MISSING,
+            _value(light.mireds) if light is not None else MISSING,
+        )
+
+        with self._lock:
+            index = self._index.get(str(model.id))
+            if index is None:
+                index = self._append(model.id)
+            for (name, _, _), value in zip(_COLUMNS, row):
+                self._columns[name][index] = value
+
+    def retain(self, device_ids):
+        """Mark all devices except the given ones as removed."""
+        keep = {str(device_id) for device_id in device_ids}
+        with self._lock:
+            for device_id, index in self._index.items():
+                if device_id not in keep:
+                    self._columns["present"][index] = 0
+
+    def _append(self, device_id):
+        index = self._size
+        self._index[str(device_id)] = index
+        self._device_ids.append(device_id)
+        self._size += 1
+
+        if numpy is not None:
+            capacity = len(self._columns["present"])
+            if index >= capacity:
+                for name, column in self._columns.items():
+                    grown = numpy.full(capacity * 2, MISSING, dtype=column.dtype)
+                    grown[:capacity] = column
+                    self._columns[name] = grown
+        else:
+            for column in self._columns.values():
+                column.append(MISSING)
+        return index
+
+    def count(self, name, indices=None):
+        """Return how many present devices (default all) have a truthy value.
+
+        Missing values are not counted.
+        """
+        column = self.column(name)
+        present = self.column("present")
+        if numpy is not None:
+            if indices is not None:
+                column = column[indices]
+                present = present[indices]
+            return int(numpy.count_nonzero((column > 0) & (present > 0)))
+        if indices is None:
+            indices = range(self._size)
+        return sum(1 for index in indices if column[index] > 0 and present[index])
+
+    def lights_on(self, device_ids=None):
+        """Return how many of the lights (default all) are on."""
+        indices = None if device_ids is None else self.indices(device_ids)
+        return self.count("state", indices)
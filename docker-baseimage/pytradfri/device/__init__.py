@@ -5,22 +5,50 @@ from pytradfri.const import (
     ATTR_APPLICATION_TYPE,
     ROOT_DEVICES,
     ATTR_LAST_SEEN,
-    ATTR_REACHABLE_STATE,
-    ATTR_LIGHT_CONTROL,
-    ATTR_SWITCH_PLUG,
     ATTR_DEVICE_INFO,
-    ATTR_START_BLINDS,
-    ROOT_SIGNAL_REPEATER,
 )
 from pytradfri.device.blind_control import BlindControl
 from pytradfri.device.light_control import LightControl
 from pytradfri.device.signal_repeater_control import SignalRepeaterControl
 from pytradfri.device.socket_control import SocketControl
+from pytradfri.model import (
+    CAPABILITY_BLIND,
+    CAPABILITY_LIGHT,
+    CAPABILITY_SIGNAL_REPEATER,
+    CAPABILITY_SOCKET,
+    DeviceModel,
+)
 from pytradfri.resource import ApiResource
 
 
 class Device(ApiResource):
-    """Base class for devices."""
+    """Base class for devices.
+
+    The raw state is parsed once into `model`, which is updated in place when
+    raw is replaced, e.g. by an observation.
+    """
+
+    _model = None
+    _device_info = None
+    _light_control = None
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw):
+        self._raw = raw
+        if self._model is not None and raw is not None:
+            self._model.update(raw)
+        self._light_control = None
+
+    @property
+    def model(self):
+        """Parsed state of the device."""
+        if self._model is None:
+            self._model = DeviceModel(self._raw)
+        return self._model
 
     @property
     def application_type(self):
@@ -32,7 +60,10 @@ class Device(ApiResource):
 
     @property
     def device_info(self):
-        return DeviceInfo(self)
+        if self._device_info is None:
+            # Reads the raw state of the device, so it never gets stale.
+            self._device_info = DeviceInfo(self)
+        return self._device_info
 
     @property
     def last_seen(self):
@@ -42,19 +73,24 @@ class Device(ApiResource):
 
     @property
     def reachable(self):
-        return self.raw.get(ATTR_REACHABLE_STATE) == 1
+        return self.model.reachable
+
+    def _has_capability(self, capability):
+        return self.raw is not None and bool(self.model.capabilities & capability)
 
     @property
     def has_light_control(self):
-        return self.raw is not None and len(self.raw.get(ATTR_LIGHT_CONTROL, "")) > 0
+        return self._has_capability(CAPABILITY_LIGHT)
 
     @property
     def light_control(self):
-        return LightControl(self)
+        if self._light_control is None:
+            self._light_control = LightControl(self)
+        return self._light_control
 
     @property
     def has_socket_control(self):
-        return self.raw is not None and len(self.raw.get(ATTR_SWITCH_PLUG, "")) > 0
+        return self._has_capability(CAPABILITY_SOCKET)
 
     @property
     def socket_control(self):
@@ -63,7 +99,7 @@ class Device(ApiResource):
 
     @property
     def has_blind_control(self):
-        return self.raw is not None and len(self.raw.get(ATTR_START_BLINDS, "")) > 0
+        return self._has_capability(CAPABILITY_BLIND)
 
     @property
     def blind_control(self):
@@ -72,7 +108,7 @@ class Device(ApiResource):
 
     @property
     def has_signal_repeater_control(self):
-        return self.raw is not None and len(self.raw.get(ROOT_SIGNAL_REPEATER, "")) > 0
+        return self._has_capability(CAPABILITY_SIGNAL_REPEATER)
 
     @property
     def signal_repeater_control(self):
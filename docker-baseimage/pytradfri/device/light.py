@@ -1,13 +1,9 @@
 """Represent a light."""
-from pytradfri.color import supported_features
 from pytradfri.const import (
-    ATTR_DEVICE_STATE,
     SUPPORT_BRIGHTNESS,
     ATTR_LIGHT_DIMMER,
     SUPPORT_COLOR_TEMP,
-    ATTR_LIGHT_MIREDS,
     SUPPORT_HEX_COLOR,
-    ATTR_LIGHT_COLOR_HEX,
     SUPPORT_XY_COLOR,
     ATTR_LIGHT_COLOR_X,
     ATTR_LIGHT_COLOR_Y,
@@ -24,38 +20,49 @@ class Light:
     pdf
     """
 
+    __slots__ = ("device", "index")
+
     def __init__(self, device, index):
         self.device = device
         self.index = index
 
+    @property
+    def model(self):
+        """Parsed state of the light, see DeviceModel."""
+        return self.device.model.lights[self.index]
+
     @property
     def supported_features(self):
-        return supported_features(self.raw)
+        return self.model.features
 
     @property
     def state(self):
-        return self.raw.get(ATTR_DEVICE_STATE) == 1
+        return self.model.state
 
     @property
     def dimmer(self):
-        if self.supported_features & SUPPORT_BRIGHTNESS:
-            return self.raw.get(ATTR_LIGHT_DIMMER)
+        model = self.model
+        if model.features & SUPPORT_BRIGHTNESS:
+            return model.dimmer
 
     @property
     def color_temp(self):
-        if self.supported_features & SUPPORT_COLOR_TEMP:
-            if self.raw.get(ATTR_LIGHT_MIREDS) != 0:
-                return self.raw.get(ATTR_LIGHT_MIREDS)
+        model = self.model
+        if model.features & SUPPORT_COLOR_TEMP:
+            if model.mireds != 0:
+                return model.mireds
 
     @property
     def hex_color(self):
-        if self.supported_features & SUPPORT_HEX_COLOR:
-            return self.raw.get(ATTR_LIGHT_COLOR_HEX)
+        model = self.model
+        if model.features & SUPPORT_HEX_COLOR:
+            return model.hex_color
 
     @property
     def xy_color(self):
-        if self.supported_features & SUPPORT_XY_COLOR:
-            return (self.raw.get(ATTR_LIGHT_COLOR_X), self.raw.get(ATTR_LIGHT_COLOR_Y))
+        model = self.model
+        if model.features & SUPPORT_XY_COLOR:
+            return model.xy
 
     @property
     def hsb_xy_color(self):
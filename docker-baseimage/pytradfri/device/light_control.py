@@ -1,4 +1,5 @@
 """Class to control the lights."""
+from pytradfri.capabilities import light_capabilities
 from pytradfri.color import COLORS
 from pytradfri.command import Command
 from pytradfri.const import (
@@ -28,31 +29,22 @@ class LightControl:
 
     def __init__(self, device):
         self._device = device
-
-        self.can_set_dimmer = None
-        self.can_set_temp = None
-        self.can_set_xy = None
-        self.can_set_color = None
-        self.can_combine_commands = None
-
-        if ATTR_LIGHT_DIMMER in self.raw[0]:
-            self.can_set_dimmer = True
-
-        if ATTR_LIGHT_MIREDS in self.raw[0]:
-            self.can_set_temp = True
-
-        if ATTR_LIGHT_COLOR_X in self.raw[0]:
-            self.can_set_xy = True
-
-        if ATTR_LIGHT_COLOR_HUE in self.raw[0]:
-            self.can_set_color = True
-
-        # Currently uncertain which bulbs are capable of setting
-        # multiple values simultaneously. As of gateway firmware
-        # 1.3.14 1st party bulbs do not seem to support this properly,
-        # but (at least some) hue bulbs do.
-        if "Philips" in self._device.device_info.manufacturer:
-            self.can_combine_commands = True
+        self._lights = None
+
+        # Detected once per model and firmware, see light_capabilities.
+        model = device.model
+        capabilities = light_capabilities(
+            model.manufacturer,
+            model.model_number,
+            model.firmware_version,
+            self.raw[0],
+            reachable=model.reachable,
+        )
+        self.can_set_dimmer = capabilities.can_set_dimmer
+        self.can_set_temp = capabilities.can_set_temp
+        self.can_set_xy = capabilities.can_set_xy
+        self.can_set_color = capabilities.can_set_color
+        self.can_combine_commands = capabilities.can_combine_commands
 
         self.min_mireds = RANGE_MIREDS[0]
         self.max_mireds = RANGE_MIREDS[1]
@@ -71,7 +63,11 @@ class LightControl:
     @property
     def lights(self):
         """Return light objects of the light control."""
-        return [Light(self._device, i) for i in range(len(self.raw))]
+        if self._lights is None:
+            # Lights read the state of the device, so they can be reused
+            # until the device is updated, which replaces the light control.
+            self._lights = [Light(self._device, i) for i in range(len(self.raw))]
+        return list(self._lights)
 
     def set_state(self, state, *, index=0):
         """Set state of a light."""
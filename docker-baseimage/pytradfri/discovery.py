@@ -0,0 +1,190 @@
+"""Discover all resources of a gateway with bounded concurrency."""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from .error import RequestError
+from .gateway import Gateway
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class DiscoveryResult:
+    """Resources found on the gateway and the requests that failed.
+
+    Errors are keyed by the path of the failed command, e.g. "15001/65537".
+    """
+
+    def __init__(self):
+        self.devices = []
+        self.groups = []
+        self.moods = {}  # group id -> moods
+        self.smart_tasks = []
+        self.errors = {}
+
+    @property
+    def complete(self):
+        """True if every resource was fetched."""
+        return not self.errors
+
+    def keep_failed(self, previous):
+        """Keep the resources of a previous result that failed to load now.
+
+        A resource is kept when fetching it or listing it failed, so an
+        unreachable gateway doesn't wipe what was known. Resources missing
+        from a successful listing are gone and are not kept.
+        """
+        self.devices = self._merge(self.devices, previous.devices)
+        fetched_group_ids = {str(group.id) for group in self.groups}
+        self.groups = self._merge(self.groups, previous.groups)
+        self.smart_tasks = self._merge(self.smart_tasks, previous.smart_tasks)
+
+        group_ids = {str(group.id) for group in self.groups}
+        current_keys = {str(group_id): group_id for group_id in self.moods}
+        for group_id, moods in previous.moods.items():
+            key = str(group_id)
+            if key not in group_ids:
+                continue
+            if key not in fetched_group_ids:
+                # The moods of a kept group were never listed.
+                failed = moods
+            else:
+                failed = [mood for mood in moods if self._failed(mood)]
+            group_id = current_keys.get(key, group_id)
+            current = self.moods.get(group_id, [])
+            self.moods[group_id] = self._merge(current, failed, keep_all=True)
+            if not self.moods[group_id]:
+                del self.moods[group_id]
+
+    def _merge(self, current, previous, *, keep_all=False):
+        ids = {str(resource.id) for resource in current}
+        kept = [
+            resource
+            for resource in previous
+            if str(resource.id) not in ids and (keep_all or self._failed(resource))
+        ]
+        return current + kept
+
+    def _failed(self, resource):
+        """True if fetching or listing the resource failed."""
+        path = [str(part) for part in resource.path]
+        return any(
+            "/".join(path[:length]) in self.errors
+            for length in range(1, len(path) + 1)
+        )
+
+    def __repr__(self):
+        return "<DiscoveryResult {} devices, {} groups, {} errors>".format(
+            len(self.devices), len(self.groups), len(self.errors)
+        )
+
+
+class Discovery:
+    """Fetch devices, groups, moods and smart tasks of a gateway.
+
+    `request` executes a single command and may be the request method of
+    either APIFactory. At most `max_workers` commands are executed at once.
+    A failed command is recorded in the result and discovery continues, so
+    one unreachable device does not stall the rest.
+
+    `progress(kind, done, total)` is called from the worker threads after
+    every fetched resource, with kind one of "devices", "groups", "moods"
+    or "smart_tasks".
+    """
+
+    def __init__(self, request, gateway=None, *, max_workers=8, progress=None):
+        if max_workers < 1:
+            raise ValueError("Max workers has to be at least 1.")
+
+        self._request = request
+        self._gateway = gateway or Gateway()
+        self._max_workers = max_workers
+        self._progress = progress
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Discover all resources. Returns a DiscoveryResult."""
+        result = DiscoveryResult()
+
+        with ThreadPoolExecutor(
+            max_workers=self._max_workers, thread_name_prefix="pytradfri-discovery"
+        ) as executor:
+            # The listings are independent, fetch them at once.
+            listings = {
+                kind: executor.submit(self._fetch, result, command)
+                for kind, command in (
+                    ("devices", self._gateway.get_devices()),
+                    ("groups", self._gateway.get_groups()),
+                    ("smart_tasks", self._gateway.get_smart_tasks()),
+                )
+            }
+            commands = {kind: future.result() for kind, future in listings.items()}
+
+            fetches = {
+                kind: self._fetch_all(executor, result, kind, commands[kind] or [])
+                for kind in ("devices", "groups", "smart_tasks")
+            }
+            result.devices = self._collect(fetches["devices"])
+            result.groups = self._collect(fetches["groups"])
+            result.smart_tasks = self._collect(fetches["smart_tasks"])
+
+            # Moods are listed per group, so they can only be fetched now.
+            mood_listings = {
+                group.id: executor.submit(
+                    self._fetch, result, self._gateway.get_moods(group.id)
+                )
+                for group in result.groups
+            }
+            mood_commands = [
+                command
+                for future in mood_listings.values()
+                for command in future.result() or []
+            ]
+            for mood in self._collect(
+                self._fetch_all(executor, result, "moods", mood_commands)
+            ):
+                result.moods.setdefault(mood.path[1], []).append(mood)
+
+        if result.errors:
+            _LOGGER.warning(
+                "Discovery of %d resources failed: %s",
+                len(result.errors),
+                ", ".join(sorted(result.errors)),
+            )
+        return result
+
+    def _fetch(self, result, api_command):
+        """Execute a command. Returns None if it failed."""
+        try:
+            return self._request(api_command)
+        except RequestError as err:
+            with self._lock:
+                result.errors[api_command.path_str] = err
+            return None
+
+    def _fetch_all(self, executor, result, kind, api_commands):
+        total = len(api_commands)
+        counter = iter(range(1, total + 1))
+
+        def fetch(api_command):
+            resource = self._fetch(result, api_command)
+            if self._progress is not None:
+                with self._lock:
+                    done = next(counter)
+                self._progress(kind, done, total)
+            return resource
+
+        return [executor.submit(fetch, api_command) for api_command in api_commands]
+
+    @staticmethod
+    def _collect(futures):
+        """Return the results of the futures in order, skipping failures."""
+        resources = (future.result() for future in futures)
+        return [resource for resource in resources if resource is not None]
+
+
+def discover(request, gateway=None, *, max_workers=8, progress=None):
+    """Discover all resources of a gateway. Returns a DiscoveryResult."""
+    return Discovery(
+        request, gateway, max_workers=max_workers, progress=progress
+    ).run()
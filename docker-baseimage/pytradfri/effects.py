@@ -0,0 +1,518 @@
+"""Multi-step effects run client side across many lights.
+
+A Timeline describes an effect as keyframes per light. It is compiled into
+frames that set the next keyframe with a transition time, so the bulbs
+interpolate between sparse keyframes instead of getting a command per
+frame. EffectEngine sends the frames from an asyncio timer wheel, within a
+command budget shared by all running effects.
+"""
+import asyncio
+import inspect
+import logging
+import math
+
+from .command import Command
+from .const import (
+    ATTR_LIGHT_CONTROL,
+    ATTR_LIGHT_DIMMER,
+    ATTR_LIGHT_MIREDS,
+    ATTR_TRANSITION_TIME,
+    RANGE_BRIGHTNESS,
+    RANGE_MIREDS,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# The gateway takes transition times in tenths of a second.
+TRANSITION_UNIT = 0.1
+
+# Most commands a frame is sent as, see Frame.size.
+MAX_FRAME_SIZE = 2
+
+
+def linear(progress):
+    return progress
+
+
+def ease_in(progress):
+    """Start slowly, like the sun rising."""
+    return progress * progress
+
+
+def ease_in_out(progress):
+    return (1 - math.cos(math.pi * progress)) / 2
+
+
+class Keyframe:
+    """Values a light reaches at `at` seconds into the timeline."""
+
+    __slots__ = ("at", "dimmer", "color_temp", "final")
+
+    def __init__(self, at, *, dimmer=None, color_temp=None, final=True):
+        self.at = at
+        self.dimmer = dimmer
+        self.color_temp = color_temp
+        # Keyframes that aren't final may be dropped to stay within budget.
+        self.final = final
+
+    def merge(self, other):
+        """Take the values set by a later keyframe at the same time."""
+        if other.dimmer is not None:
+            self.dimmer = other.dimmer
+        if other.color_temp is not None:
+            self.color_temp = other.color_temp
+        self.final = self.final or other.final
+
+    def __repr__(self):
+        return "<Keyframe {:.1f}s dimmer: {} color_temp: {}>".format(
+            self.at, self.dimmer, self.color_temp
+        )
+
+
+class Frame:
+    """Command(s) moving a light to a keyframe, sent at `at`."""
+
+    __slots__ = ("at", "device", "keyframe", "transition")
+
+    def __init__(self, at, device, keyframe, transition):
+        self.at = at  # seconds into the timeline
+        self.device = device
+        self.keyframe = keyframe
+        self.transition = transition  # seconds
+
+    def commands(self, late=0):
+        """Return the commands of the frame sent `late` seconds too late."""
+        transition = max(0, round((self.transition - late) / TRANSITION_UNIT))
+        light_control = self.device.light_control
+        values = {}
+        if self.keyframe.dimmer is not None:
+            values[ATTR_LIGHT_DIMMER] = self.keyframe.dimmer
+        if self.keyframe.color_temp is not None:
+            values[ATTR_LIGHT_MIREDS] = self.keyframe.color_temp
+        if len(values) > 1 and not light_control.can_combine_commands:
+            return [
+                self._command({key: value, ATTR_TRANSITION_TIME: transition})
+                for key, value in values.items()
+            ]
+        values[ATTR_TRANSITION_TIME] = transition
+        return [self._command(values)]
+
+    @property
+    def size(self):
+        """Number of commands the frame is sent as."""
+        keyframe = self.keyframe
+        if (
+            keyframe.dimmer is not None
+            and keyframe.color_temp is not None
+            and not self.device.light_control.can_combine_commands
+        ):
+            return MAX_FRAME_SIZE
+        return 1
+
+    def _command(self, values):
+        return Command("put", self.device.path, {ATTR_LIGHT_CONTROL: [values]})
+
+    def __repr__(self):
+        return "<Frame {:.1f}s {} {}>".format(self.at, self.device.id, self.keyframe)
+
+
+def _clamp(value, rnge):
+    return None if value is None else min(max(round(value), rnge[0]), rnge[1])
+
+
+class Timeline:
+    """Keyframes of an effect per light.
+
+    Times are in seconds from the start of the effect. Dimmer and color
+    temperature ranges are given as (start, end) tuples.
+    """
+
+    def __init__(self):
+        self._devices = {}
+        self._keyframes = {}
+
+    @property
+    def devices(self):
+        return list(self._devices.values())
+
+    @property
+    def duration(self):
+        """Seconds until the last keyframe."""
+        return max(
+            (keyframes[-1].at for keyframes in self.keyframes().values()), default=0
+        )
+
+    def set(self, lights, at, *, dimmer=None, color_temp=None):
+        """Let the lights reach the values at the given time."""
+        for light in lights:
+            self._add(light, Keyframe(at, dimmer=dimmer, color_temp=color_temp))
+        return self
+
+    def ramp(
+        self,
+        lights,
+        start,
+        duration,
+        *,
+        dimmer=None,
+        color_temp=None,
+        curve=linear,
+        offset=0,
+        resolution=1.0,
+    ):
+        """Move the lights along the curve between two values.
+
+        The curve is sampled every `resolution` seconds, the bulbs move
+        linearly between the samples. Every light starts `offset` seconds
+        after the previous one, e.g. for a chase.
+        """
+        steps = max(1, math.ceil(duration / resolution))
+        for number, light in enumerate(lights):
+            light_start = start + number * offset
+            for step in range(steps + 1):
+                progress = curve(step / steps)
+                self._add(
+                    light,
+                    Keyframe(
+                        light_start + duration * step / steps,
+                        dimmer=_interpolate(dimmer, progress),
+                        color_temp=_interpolate(color_temp, progress),
+                        final=step in (0, steps),
+                    ),
+                )
+        return self
+
+    def keyframes(self):
+        """Return the keyframes sorted by time per device id."""
+        keyframes = {}
+        for device_id, unsorted in self._keyframes.items():
+            merged = []
+            for keyframe in sorted(unsorted, key=lambda keyframe: keyframe.at):
+                if merged and abs(merged[-1].at - keyframe.at) < TRANSITION_UNIT:
+                    merged[-1].merge(keyframe)
+                else:
+                    merged.append(
+                        Keyframe(
+                            keyframe.at,
+                            dimmer=keyframe.dimmer,
+                            color_temp=keyframe.color_temp,
+                            final=keyframe.final,
+                        )
+                    )
+            keyframes[device_id] = merged
+        return keyframes
+
+    def compile(self, rate, *, min_interval=0.5):
+        """Return the frames of the timeline sorted by time.
+
+        Keyframes that aren't final are dropped until no light gets more
+        than its share of `rate` commands per second, or more than one
+        command every `min_interval` seconds.
+        """
+        keyframes = self.keyframes()
+        if not keyframes:
+            return []
+
+        frames = []
+        for device_id, device_keyframes in keyframes.items():
+            device = self._devices[device_id]
+            per_keyframe = 1
+            if not device.light_control.can_combine_commands:
+                per_keyframe = 2
+            interval = max(min_interval, len(keyframes) * per_keyframe / rate)
+            frames.extend(_frames(device, _thin(device_keyframes, interval)))
+        frames.sort(key=lambda frame: frame.at)
+        return frames
+
+    def _add(self, light, keyframe):
+        key = str(light.id)
+        self._devices[key] = light
+        self._keyframes.setdefault(key, []).append(keyframe)
+
+
+def _interpolate(values, progress):
+    if values is None:
+        return None
+    start, end = values
+    return start + (end - start) * progress
+
+
+def _thin(keyframes, interval):
+    """Drop keyframes closer than `interval` to the previous one kept."""
+    kept = [keyframes[0]]
+    for keyframe in keyframes[1:]:
+        if keyframe.final or keyframe.at - kept[-1].at >= interval:
+            kept.append(keyframe)
+    return kept
+
+
+def _frames(device, keyframes):
+    """Set each keyframe when the light reached the one before it."""
+    frames = []
+    previous = None
+    for keyframe in keyframes:
+        keyframe = Keyframe(
+            keyframe.at,
+            dimmer=_clamp(keyframe.dimmer, RANGE_BRIGHTNESS),
+            color_temp=_clamp(keyframe.color_temp, RANGE_MIREDS),
+        )
+        if previous is None:
+            # The light jumps to the first keyframe.
+            frames.append(Frame(keyframe.at, device, keyframe, 0))
+        else:
+            # One transition unit after the previous frame, so the light
+            # doesn't skip the first keyframe.
+            at = previous.at
+            if len(frames) == 1:
+                at += TRANSITION_UNIT
+            frames.append(Frame(at, device, keyframe, keyframe.at - at))
+        previous = keyframe
+    return frames
+
+
+def fade(lights, duration, *, dimmer=None, color_temp=None, curve=linear):
+    """Fade each light from its current state to the given values."""
+    timeline = Timeline()
+    for light in lights:
+        state = light.model.lights[0]
+        timeline.ramp(
+            [light],
+            0,
+            duration,
+            dimmer=None if dimmer is None else (state.dimmer or 0, dimmer),
+            color_temp=(
+                None
+                if color_temp is None
+                else (state.mireds or RANGE_MIREDS[1], color_temp)
+            ),
+            curve=curve,
+        )
+    return timeline
+
+
+def sunrise(lights, duration):
+    """Slowly brighten the lights from a warm glow to cool daylight."""
+    return Timeline().ramp(
+        lights,
+        0,
+        duration,
+        dimmer=(1, RANGE_BRIGHTNESS[1]),
+        color_temp=(RANGE_MIREDS[1], 250),
+        curve=ease_in,
+        resolution=max(1.0, duration / 60),
+    )
+
+
+def chase(lights, period, *, cycles=1, low=1, high=RANGE_BRIGHTNESS[1]):
+    """Let a pulse of light run along the lights `cycles` times."""
+    lights = list(lights)
+    timeline = Timeline()
+    if not lights:
+        return timeline
+    step = period / len(lights)
+    for cycle in range(cycles):
+        start = cycle * period
+        timeline.ramp(lights, start, step, dimmer=(low, high), offset=step)
+        timeline.ramp(lights, start + step, step, dimmer=(high, low), offset=step)
+    return timeline
+
+
+class TimerWheel:
+    """Hashed timer wheel with `slots` slots of `tick` seconds.
+
+    Scheduling and advancing are O(1) per item regardless of how many
+    frames are scheduled; items further out than a full turn of the wheel
+    wait in their slot for the turns to pass.
+    """
+
+    def __init__(self, tick=TRANSITION_UNIT, slots=512):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._ticks = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def ticks(self):
+        """Number of ticks the wheel advanced."""
+        return self._ticks
+
+    def schedule(self, ticks, item):
+        """Schedule item to be due in the given number of ticks (at least 1)."""
+        due = self._ticks + max(1, ticks)
+        self._slots[due % len(self._slots)].append((due, item))
+        self._size += 1
+
+    def advance(self):
+        """Advance by one tick, returns the items that are due."""
+        self._ticks += 1
+        slot = self._slots[self._ticks % len(self._slots)]
+        due = [item for tick, item in slot if tick <= self._ticks]
+        if due:
+            slot[:] = [(tick, item) for tick, item in slot if tick > self._ticks]
+            self._size -= len(due)
+        return due
+
+
+class Effect:
+    """A running effect."""
+
+    def __init__(self, timeline, frames):
+        self.timeline = timeline
+        self.pending = len(frames)
+        self.sent = 0
+        self.failed = 0
+        self.cancelled = False
+        self.done = asyncio.get_running_loop().create_future()
+
+    def cancel(self):
+        """Stop sending the frames of the effect."""
+        self.cancelled = True
+        self._finish()
+
+    def _frame_done(self, sent=0, failed=0):
+        self.pending -= 1
+        self.sent += sent
+        self.failed += failed
+        if self.pending <= 0:
+            self._finish()
+
+    def _finish(self):
+        if not self.done.done():
+            self.done.set_result(self)
+
+    def __repr__(self):
+        return "<Effect {} pending, {} sent, {} failed>".format(
+            self.pending, self.sent, self.failed
+        )
+
+
+class EffectEngine:
+    """Run effects on the lights of a gateway.
+
+    At most `rate` commands per second (allowing bursts of `burst`, at least
+    MAX_FRAME_SIZE) are sent for all effects together. Frames that don't fit
+    into a tick wait for the next one and their transition is shortened by
+    the delay, so the lights still reach the keyframes in time. A light
+    belongs to the effect started last on it, the frames of earlier effects
+    for it are dropped.
+
+    `request` executes a command and may be a coroutine function, like the
+    request method of the aiocoap APIFactory, or a blocking function, which
+    is run in the default executor.
+    """
+
+    def __init__(self, request, *, rate=10.0, burst=None, tick=TRANSITION_UNIT):
+        if rate <= 0:
+            raise ValueError("Rate has to be greater than 0.")
+
+        self._request = request
+        self._rate = rate  # commands per second
+        # The largest frame has to fit into the bucket, or it is never sent.
+        self._burst = max(burst or rate * tick, MAX_FRAME_SIZE)
+        self._tokens = self._burst
+        self._wheel = TimerWheel(tick)
+        self._ready = []  # due frames waiting for the budget
+        self._owners = {}  # device id -> Effect
+        self._started_at = None  # loop time of tick 0 of the wheel
+        self._runner = None
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def start(self, timeline):
+        """Start running the timeline, returns its Effect.
+
+        Has to be called from within the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        frames = timeline.compile(self._rate)
+        effect = Effect(timeline, frames)
+        for device in timeline.devices:
+            previous = self._owners.get(str(device.id))
+            self._owners[str(device.id)] = effect
+            if previous is not None and previous is not effect:
+                _LOGGER.debug("Effect took over light %s", device.id)
+
+        if self._runner is None or self._runner.done():
+            self._started_at = loop.time()
+            self._wheel = TimerWheel(self._wheel.tick)
+            self._runner = loop.create_task(self._run())
+
+        now = loop.time()
+        # Seconds since the wheel last advanced.
+        begin = now - (self._started_at + self._wheel.ticks * self._wheel.tick)
+        for frame in frames:
+            ticks = math.ceil((begin + frame.at) / self._wheel.tick)
+            self._wheel.schedule(ticks, (effect, frame, now + frame.at))
+        if not frames:
+            effect.cancel()
+        return effect
+
+    async def run(self, timeline):
+        """Run the timeline until all its frames are sent."""
+        return await self.start(timeline).done
+
+    def stop(self, lights):
+        """Stop running effects on the lights, other lights keep running."""
+        for light in lights:
+            self._owners.pop(str(light.id), None)
+
+    def cancel_all(self):
+        """Stop all running effects."""
+        for effect in set(self._owners.values()):
+            effect.cancel()
+        self._owners.clear()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        tick = self._wheel.tick
+        while len(self._wheel) or self._ready:
+            next_tick = self._started_at + (self._wheel.ticks + 1) * tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            self._ready.extend(self._wheel.advance())
+            self._tokens = min(self._burst, self._tokens + self._rate * tick)
+            self._dispatch(loop)
+
+    def _dispatch(self, loop):
+        ready = []
+        for effect, frame, send_at in self._ready:
+            owner = self._owners.get(str(frame.device.id))
+            if effect.cancelled or owner is not effect:
+                self._frame_done(effect)
+                continue
+            size = frame.size
+            if self._tokens < size:
+                ready.append((effect, frame, send_at))
+                continue
+            self._tokens -= size
+            late = max(0, loop.time() - send_at)
+            loop.create_task(self._send(effect, frame, late))
+        self._ready = ready
+
+    async def _send(self, effect, frame, late):
+        sent = failed = 0
+        for command in frame.commands(late):
+            try:
+                await self._call(command)
+                sent += 1
+            except Exception as err:  # pylint: disable=broad-except
+                _LOGGER.debug("Effect frame %s failed: %s", frame, err)
+                failed += 1
+        self._frame_done(effect, sent, failed)
+
+    def _frame_done(self, effect, sent=0, failed=0):
+        effect._frame_done(sent, failed)
+        if effect.pending <= 0:
+            for device_id, owner in list(self._owners.items()):
+                if owner is effect:
+                    del self._owners[device_id]
+
+    async def _call(self, command):
+        if inspect.iscoroutinefunction(self._request):
+            return await self._request(command)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._request, command)
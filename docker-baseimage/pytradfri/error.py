@@ -41,3 +41,40 @@ class ServerError(RequestError):
     """
 
     pass
+
+
+class StopObserving(PytradfriError):
+    """Raised by an observation callback to end the observation.
+
+    The err_callback of the observation is not called.
+    """
+
+    pass
+
+
+class CircuitOpenError(RequestError):
+    """Error when a command failed fast, the device or gateway isn't answering."""
+
+    pass
+
+
+class BatchError(RequestError):
+    """Error when one or more commands of a list of commands failed.
+
+    `results` holds the result of every command in order, with None for
+    the failed ones. `errors` maps the index of each failed command to its
+    error.
+    """
+
+    def __init__(self, results, errors):
+        super().__init__(
+            "{} of {} commands failed: {}".format(
+                len(errors),
+                len(results),
+                ", ".join(
+                    "#{} {}".format(index, err) for index, err in sorted(errors.items())
+                ),
+            )
+        )
+        self.results = results
+        self.errors = errors
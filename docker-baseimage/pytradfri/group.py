@@ -7,10 +7,8 @@ from .const import (
     ATTR_LIGHT_COLOR_Y,
     ATTR_LIGHT_COLOR_HEX,
     ATTR_ID,
-    ATTR_GROUP_MEMBERS,
     ATTR_GROUP_ID,
     ATTR_MOOD,
-    ATTR_HS_LINK,
     ATTR_TRANSITION_TIME,
     RANGE_X,
     RANGE_Y,
@@ -23,16 +21,36 @@ from .const import (
     RANGE_BRIGHTNESS,
 )
 from .error import ColorError
+from .model import GroupModel
 from .resource import ApiResource
 
 
 class Group(ApiResource):
     """Represent a group."""
 
+    _model = None
+
     def __init__(self, gateway, raw):
         super().__init__(raw)
         self._gateway = gateway
 
+    @property
+    def raw(self):
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw):
+        self._raw = raw
+        if self._model is not None and raw is not None:
+            self._model.update(raw)
+
+    @property
+    def model(self):
+        """Parsed state of the group."""
+        if self._model is None:
+            self._model = GroupModel(self._raw)
+        return self._model
+
     @property
     def path(self):
         return [ROOT_GROUPS, self.id]
@@ -54,12 +72,7 @@ class Group(ApiResource):
     @property
     def member_ids(self):
         """Members of this group."""
-        info = self.raw.get(ATTR_GROUP_MEMBERS, {})
-
-        if not info or ATTR_HS_LINK not in info:
-            return []
-
-        return info[ATTR_HS_LINK].get(ATTR_ID, [])
+        return list(self.model.member_ids)
 
     @property
     def mood_id(self):
@@ -0,0 +1,181 @@
+"""Compact typed view of the raw state of devices and groups.
+
+The raw dicts are parsed once into slotted objects, which are updated in
+place when the resource is observed, instead of building wrapper objects
+on every property access.
+"""
+from .capabilities import light_capabilities
+from .const import (
+    ATTR_APPLICATION_TYPE,
+    ATTR_DEVICE_INFO,
+    ATTR_DEVICE_STATE,
+    ATTR_GROUP_MEMBERS,
+    ATTR_HS_LINK,
+    ATTR_ID,
+    ATTR_LAST_SEEN,
+    ATTR_LIGHT_COLOR_HEX,
+    ATTR_LIGHT_COLOR_HUE,
+    ATTR_LIGHT_COLOR_SATURATION,
+    ATTR_LIGHT_COLOR_X,
+    ATTR_LIGHT_COLOR_Y,
+    ATTR_LIGHT_CONTROL,
+    ATTR_LIGHT_DIMMER,
+    ATTR_LIGHT_MIREDS,
+    ATTR_MOOD,
+    ATTR_NAME,
+    ATTR_REACHABLE_STATE,
+    ATTR_START_BLINDS,
+    ATTR_SWITCH_PLUG,
+    ROOT_SIGNAL_REPEATER,
+)
+
+# Device capabilities, see DeviceModel.capabilities.
+CAPABILITY_LIGHT = 1
+CAPABILITY_SOCKET = 2
+CAPABILITY_BLIND = 4
+CAPABILITY_SIGNAL_REPEATER = 8
+
+_CAPABILITY_ATTRS = (
+    (ATTR_LIGHT_CONTROL, CAPABILITY_LIGHT),
+    (ATTR_SWITCH_PLUG, CAPABILITY_SOCKET),
+    (ATTR_START_BLINDS, CAPABILITY_BLIND),
+    (ROOT_SIGNAL_REPEATER, CAPABILITY_SIGNAL_REPEATER),
+)
+
+# Keys of the device info, see DeviceInfo.
+_ATTR_MANUFACTURER = "0"
+_ATTR_MODEL_NUMBER = "1"
+_ATTR_FIRMWARE_VERSION = "3"
+
+
+class LightState:
+    """State of a single light of a device."""
+
+    __slots__ = (
+        "state",
+        "dimmer",
+        "mireds",
+        "hex_color",
+        "xy",
+        "hue",
+        "saturation",
+        "features",
+    )
+
+    def __init__(self, raw, features):
+        self.update(raw, features)
+
+    def update(self, raw, features):
+        self.state = raw.get(ATTR_DEVICE_STATE) == 1
+        self.dimmer = raw.get(ATTR_LIGHT_DIMMER)
+        self.mireds = raw.get(ATTR_LIGHT_MIREDS)
+        self.hex_color = raw.get(ATTR_LIGHT_COLOR_HEX)
+        x, y = raw.get(ATTR_LIGHT_COLOR_X), raw.get(ATTR_LIGHT_COLOR_Y)
+        self.xy = (x, y) if x is not None and y is not None else None
+        self.hue = raw.get(ATTR_LIGHT_COLOR_HUE)
+        self.saturation = raw.get(ATTR_LIGHT_COLOR_SATURATION)
+        self.features = features
+
+    def __repr__(self):
+        return "<LightState {} dimmer: {}, mireds: {}, features: {}>".format(
+            "on" if self.state else "off", self.dimmer, self.mireds, self.features
+        )
+
+
+class DeviceModel:
+    """Parsed state of a device."""
+
+    __slots__ = (
+        "id",
+        "name",
+        "application_type",
+        "reachable",
+        "last_seen",
+        "manufacturer",
+        "model_number",
+        "firmware_version",
+        "capabilities",
+        "lights",
+    )
+
+    def __init__(self, raw):
+        self.lights = ()
+        self.update(raw)
+
+    def update(self, raw):
+        """Update from the raw state, reusing the light states."""
+        self.id = raw.get(ATTR_ID)
+        self.name = raw.get(ATTR_NAME)
+        self.application_type = raw.get(ATTR_APPLICATION_TYPE)
+        self.reachable = raw.get(ATTR_REACHABLE_STATE) == 1
+        self.last_seen = raw.get(ATTR_LAST_SEEN)
+
+        info = raw.get(ATTR_DEVICE_INFO) or {}
+        self.manufacturer = info.get(_ATTR_MANUFACTURER)
+        self.model_number = info.get(_ATTR_MODEL_NUMBER)
+        self.firmware_version = info.get(_ATTR_FIRMWARE_VERSION)
+
+        capabilities = 0
+        for attr, capability in _CAPABILITY_ATTRS:
+            if raw.get(attr):
+                capabilities |= capability
+        self.capabilities = capabilities
+
+        lights_raw = raw.get(ATTR_LIGHT_CONTROL) or ()
+        features = 0
+        if lights_raw:
+            # Shared by all devices of the same model and firmware.
+            features = light_capabilities(
+                self.manufacturer,
+                self.model_number,
+                self.firmware_version,
+                lights_raw[0],
+                reachable=self.reachable,
+            ).supported_features
+
+        if len(lights_raw) == len(self.lights):
+            for light, light_raw in zip(self.lights, lights_raw):
+                light.update(light_raw, features)
+        else:
+            self.lights = tuple(
+                LightState(light_raw, features) for light_raw in lights_raw
+            )
+
+    def __repr__(self):
+        return "<DeviceModel {} {} capabilities: {}>".format(
+            self.id, self.name, self.capabilities
+        )
+
+
+class GroupModel:
+    """Parsed state of a group."""
+
+    __slots__ = (
+        "id",
+        "name",
+        "state",
+        "dimmer",
+        "mireds",
+        "hex_color",
+        "mood_id",
+        "member_ids",
+    )
+
+    def __init__(self, raw):
+        self.update(raw)
+
+    def update(self, raw):
+        self.id = raw.get(ATTR_ID)
+        self.name = raw.get(ATTR_NAME)
+        self.state = raw.get(ATTR_DEVICE_STATE) == 1
+        self.dimmer = raw.get(ATTR_LIGHT_DIMMER)
+        self.mireds = raw.get(ATTR_LIGHT_MIREDS)
+        self.hex_color = raw.get(ATTR_LIGHT_COLOR_HEX)
+        self.mood_id = raw.get(ATTR_MOOD)
+        members = raw.get(ATTR_GROUP_MEMBERS) or {}
+        self.member_ids = tuple(members.get(ATTR_HS_LINK, {}).get(ATTR_ID, ()))
+
+    def __repr__(self):
+        return "<GroupModel {} {} members: {}>".format(
+            self.id, self.name, len(self.member_ids)
+        )
@@ -0,0 +1,301 @@
+"""In-memory registry of the devices and groups of a gateway."""
+import threading
+from time import time
+
+from .aggregate import GroupAggregates
+from .columnar import FleetColumns
+from .group import Group
+
+
+def _key(resource_id):
+    """Ids arrive as int from the gateway and as str from e.g. urls."""
+    return str(resource_id)
+
+
+def _updated_key(resource):
+    return (isinstance(resource, Group), _key(resource.id))
+
+
+def _light_state(light):
+    return (
+        light.state,
+        light.dimmer,
+        light.mireds,
+        light.hex_color,
+        light.xy,
+        light.hue,
+        light.saturation,
+    )
+
+
+def _state(resource):
+    """Return the parsed state of the resource as a comparable tuple.
+
+    The last seen time of a device is left out, it changes whenever the
+    device reports even if its state doesn't.
+    """
+    model = resource.model
+    if isinstance(resource, Group):
+        return (
+            model.name,
+            model.state,
+            model.dimmer,
+            model.mireds,
+            model.hex_color,
+            model.mood_id,
+            model.member_ids,
+        )
+    return (
+        model.name,
+        model.reachable,
+        model.firmware_version,
+        model.capabilities,
+        tuple(_light_state(light) for light in model.lights),
+    )
+
+
+class Registry:
+    """Index devices and groups by id, by name and by group membership.
+
+    All lookups are dict based. The registry is safe to read from multiple
+    threads while it is being refreshed.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._devices = {}
+        self._lights = []
+        self._groups = {}
+        self._devices_by_name = {}
+        self._groups_by_name = {}
+        self._device_groups = {}
+        self._moods = {}
+        self._smart_tasks = []
+        self._updated = {}
+        self._states = {}
+        # Bumped whenever any device (False) or group (True) is updated.
+        self._versions = {False: 0, True: 0}
+        self._modified = {False: None, True: None}
+        self._columns = FleetColumns()
+        self._aggregates = GroupAggregates()
+
+    @property
+    def devices(self):
+        return list(self._devices.values())
+
+    @property
+    def lights(self):
+        return list(self._lights)
+
+    @property
+    def groups(self):
+        return list(self._groups.values())
+
+    @property
+    def smart_tasks(self):
+        return list(self._smart_tasks)
+
+    @property
+    def columns(self):
+        """Columnar state of all devices, see FleetColumns."""
+        return self._columns
+
+    @property
+    def devices_version(self):
+        """Monotonically increasing version of the state of all devices."""
+        return self._versions[False]
+
+    @property
+    def groups_version(self):
+        """Monotonically increasing version of the state of all groups."""
+        return self._versions[True]
+
+    @property
+    def devices_modified(self):
+        """Unix time any device was last updated."""
+        return self._modified[False]
+
+    @property
+    def groups_modified(self):
+        """Unix time any group was last updated."""
+        return self._modified[True]
+
+    def get_device(self, device_id):
+        """Return device with given id or None."""
+        return self._devices.get(_key(device_id))
+
+    def get_light(self, device_id):
+        """Return device with given id if it has light control or None."""
+        device = self.get_device(device_id)
+        if device is None or not device.has_light_control:
+            return None
+        return device
+
+    def get_group(self, group_id):
+        """Return group with given id or None."""
+        return self._groups.get(_key(group_id))
+
+    def get_device_by_name(self, name):
+        """Return first device with given name or None."""
+        devices = self._devices_by_name.get(name)
+        return devices[0] if devices else None
+
+    def get_group_by_name(self, name):
+        """Return first group with given name or None."""
+        groups = self._groups_by_name.get(name)
+        return groups[0] if groups else None
+
+    def groups_of(self, device_id):
+        """Return the groups the device is a member of."""
+        # While groups are replaced, the index may still list removed groups.
+        groups = self._groups
+        group_ids = self._device_groups.get(_key(device_id), ())
+        return [groups[group_id] for group_id in group_ids if group_id in groups]
+
+    def lights_on(self, group_id=None):
+        """Return how many lights of the group (default all) are on."""
+        if group_id is None:
+            return self._columns.lights_on()
+        group = self.get_group(group_id)
+        if group is None:
+            return 0
+        return self._columns.lights_on(group.member_ids)
+
+    def aggregate(self, group_id):
+        """Return the state of the group derived from its members or None.
+
+        See GroupAggregate.
+        """
+        return self._aggregates.get(group_id)
+
+    def members_of(self, group_id):
+        """Return the known devices that are members of the group."""
+        group = self.get_group(group_id)
+        if group is None:
+            return []
+        devices = (self._devices.get(_key(dev_id)) for dev_id in group.member_ids)
+        return [device for device in devices if device is not None]
+
+    def moods_of(self, group_id):
+        """Return the moods available in the group."""
+        return list(self._moods.get(_key(group_id), ()))
+
+    def last_updated(self, resource):
+        """Return unix time the state of the resource was last updated."""
+        return self._updated.get(_updated_key(resource))
+
+    def touch(self, resource):
+        """Record that the state of the resource was just updated.
+
+        Nothing is recorded if the parsed state is the same as when the
+        resource was last touched, e.g. for the first response of a renewed
+        observation. Returns True if the state changed.
+        """
+        key = _updated_key(resource)
+        state = _state(resource)
+        now = time()
+        with self._lock:
+            if self._states.get(key) == state:
+                return False
+            self._states[key] = state
+            self._updated[key] = now
+            self._versions[key[0]] += 1
+            self._modified[key[0]] = now
+            if not key[0]:
+                self._columns.update(resource)
+                # Groups derive their state from their members.
+                for group_id in self._aggregates.update_device(resource):
+                    self._touch_group(group_id, now)
+            return True
+
+    def _touch_group(self, group_id, now):
+        key = (True, _key(group_id))
+        self._updated[key] = now
+        self._versions[True] += 1
+        self._modified[True] = now
+
+    def _forget_states(self, is_group, keep):
+        self._states = {
+            key: state
+            for key, state in self._states.items()
+            if key[0] != is_group or key[1] in keep
+        }
+
+    def set_devices(self, devices):
+        """Replace all devices with the given ones."""
+        with self._lock:
+            self._devices = {_key(device.id): device for device in devices}
+            self._reindex_devices()
+            self._forget_states(False, self._devices)
+            self._versions[False] += 1
+            self._modified[False] = time()
+            for device in self._devices.values():
+                self.touch(device)
+            self._columns.retain(self._devices)
+            for group_id in self._aggregates.retain_devices(self._devices):
+                self._touch_group(group_id, time())
+
+    def set_groups(self, groups):
+        """Replace all groups with the given ones."""
+        with self._lock:
+            self._groups = {_key(group.id): group for group in groups}
+            self._reindex_groups()
+            self._forget_states(True, self._groups)
+            self._versions[True] += 1
+            self._modified[True] = time()
+            for group in self._groups.values():
+                self.touch(group)
+
+    def set_moods(self, moods):
+        """Replace all moods with the given ones, keyed by group id."""
+        self._moods = {_key(group_id): list(m) for group_id, m in moods.items()}
+
+    def set_smart_tasks(self, smart_tasks):
+        """Replace all smart tasks with the given ones."""
+        self._smart_tasks = list(smart_tasks)
+
+    def add_device(self, device):
+        """Add or replace a single device."""
+        with self._lock:
+            devices = dict(self._devices)
+            devices[_key(device.id)] = device
+            self._devices = devices
+            self._reindex_devices()
+            self.touch(device)
+
+    def add_group(self, group):
+        """Add or replace a single group."""
+        with self._lock:
+            groups = dict(self._groups)
+            groups[_key(group.id)] = group
+            self._groups = groups
+            self._reindex_groups()
+            self.touch(group)
+
+    def _reindex_devices(self):
+        by_name = {}
+        for device in self._devices.values():
+            by_name.setdefault(device.name, []).append(device)
+        self._devices_by_name = by_name
+        self._lights = [dev for dev in self._devices.values() if dev.has_light_control]
+
+    def _reindex_groups(self):
+        by_name = {}
+        device_groups = {}
+        for group_id, group in self._groups.items():
+            by_name.setdefault(group.name, []).append(group)
+            for dev_id in group.member_ids:
+                device_groups.setdefault(_key(dev_id), []).append(group_id)
+        self._groups_by_name = by_name
+        self._device_groups = device_groups
+        for group_id, group in self._groups.items():
+            self._aggregates.set_group(group_id, group.member_ids)
+        self._aggregates.retain_groups(self._groups)
+
+    def __len__(self):
+        return len(self._devices) + len(self._groups)
+
+    def __repr__(self):
+        return "<Registry {} devices, {} groups>".format(
+            len(self._devices), len(self._groups)
+        )
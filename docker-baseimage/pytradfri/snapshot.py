@@ -0,0 +1,76 @@
+"""Persist the topology and state of a gateway for fast restarts."""
+import logging
+from time import time
+
+from .device import Device
+from .discovery import DiscoveryResult
+from .error import PytradfriError
+from .gateway import Gateway
+from .group import Group
+from .mood import Mood
+from .smart_task import SmartTask
+from .util import load_json, save_json
+
+_LOGGER = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def save_snapshot(filename, host, registry):
+    """Write the resources in the registry to a snapshot file.
+
+    The raw state of every resource is stored, so the resources can be
+    restored without asking the gateway. Returns True on success.
+    """
+    moods = {}
+    for group in registry.groups:
+        group_moods = registry.moods_of(group.id)
+        if group_moods:
+            moods[str(group.id)] = [mood.raw for mood in group_moods]
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "host": host,
+        "saved_at": time(),
+        "devices": [device.raw for device in registry.devices],
+        "groups": [group.raw for group in registry.groups],
+        "moods": moods,
+        "smart_tasks": [task.raw for task in registry.smart_tasks],
+    }
+    return save_json(filename, snapshot, indent=None)
+
+
+def load_snapshot(filename, host, gateway=None):
+    """Restore the resources of a snapshot file.
+
+    Returns a DiscoveryResult, or None if there is no usable snapshot for
+    the host.
+    """
+    try:
+        snapshot = load_json(filename)
+    except PytradfriError:
+        return None
+
+    if not snapshot:
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("host") != host:
+        _LOGGER.info("Ignoring snapshot %s of another host or version", filename)
+        return None
+
+    gateway = gateway or Gateway()
+    result = DiscoveryResult()
+    result.devices = [Device(raw) for raw in snapshot["devices"]]
+    result.groups = [Group(gateway, raw) for raw in snapshot["groups"]]
+    # Ids are ints on the gateway but JSON object keys are strings.
+    result.moods = {
+        int(group_id): [Mood(raw, int(group_id)) for raw in moods]
+        for group_id, moods in snapshot["moods"].items()
+    }
+    result.smart_tasks = [SmartTask(gateway, raw) for raw in snapshot["smart_tasks"]]
+
+    _LOGGER.debug(
+        "Loaded snapshot %s saved %.0fs ago",
+        filename,
+        time() - snapshot.get("saved_at", 0),
+    )
+    return result
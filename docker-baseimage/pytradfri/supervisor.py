@@ -0,0 +1,233 @@
+"""Keep the observations of a gateway alive."""
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import logging
+import random
+import threading
+from time import monotonic, time
+
+from .error import StopObserving
+
+_LOGGER = logging.getLogger(__name__)
+
+STATE_PENDING = "pending"
+STATE_ACTIVE = "active"
+STATE_RETRYING = "retrying"
+
+
+class _Watch:
+    """An observed resource and the health of its observation."""
+
+    def __init__(self, resource, callback):
+        self.resource = resource
+        self.callback = callback
+        # Bumped on every subscription, callbacks of older ones are ignored.
+        self.generation = 0
+        self.state = STATE_PENDING
+        self.due = None  # monotonic time of the next (re)subscription
+        self.subscribed_at = None
+        self.last_update = None
+        self.updates = 0
+        self.subscriptions = 0
+        self.failures = 0  # since the last successful subscription
+        self.last_error = None
+
+    def health(self):
+        return {
+            "state": self.state,
+            "subscribed_at": self.subscribed_at,
+            "last_update": self.last_update,
+            "updates": self.updates,
+            "subscriptions": self.subscriptions,
+            "failures": self.failures,
+            "last_error": None if self.last_error is None else str(self.last_error),
+        }
+
+
+class ObservationSupervisor:
+    """Own all observations of a gateway and keep them alive.
+
+    Observations are renewed `renew_margin` seconds before their `duration`
+    expires, so updates keep flowing without the caller noticing expiry. A
+    failed or stopped observation (e.g. after a protocol reset) is
+    resubscribed with exponential backoff. Subscriptions are spread out by
+    at least `stagger` seconds and renewals get random jitter, so all
+    observations don't hit the gateway at once.
+
+    `request` executes a command and may be the request method of either
+    APIFactory, or of a scheduler in front of it.
+    """
+
+    def __init__(
+        self,
+        request,
+        *,
+        duration=600,
+        renew_margin=30,
+        stagger=0.05,
+        retry_delay=5,
+        max_retry_delay=300,
+        max_workers=4,
+    ):
+        if renew_margin >= duration:
+            raise ValueError("Renew margin has to be shorter than the duration.")
+
+        self._request = request
+        self._duration = duration  # seconds
+        self._renew_margin = renew_margin  # seconds
+        self._stagger = stagger  # seconds
+        self._retry_delay = retry_delay  # seconds
+        self._max_retry_delay = max_retry_delay  # seconds
+        self._watches = {}
+        self._queue = []  # heap of (due, sequence, key)
+        self._sequence = 0
+        self._last_dispatch = None
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="pytradfri-observe"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="pytradfri-supervisor", daemon=True
+        )
+        self._thread.start()
+
+    def observe(self, resource, callback):
+        """Keep observing the resource, calling callback(resource) on updates.
+
+        Observing a resource with the same path again replaces the previous
+        resource and callback.
+        """
+        key = _path(resource)
+        with self._condition:
+            watch = self._watches.get(key)
+            if watch is None:
+                watch = self._watches[key] = _Watch(resource, callback)
+            else:
+                watch.resource = resource
+                watch.callback = callback
+                watch.generation += 1
+                watch.state = STATE_PENDING
+            self._schedule(key, watch, monotonic())
+
+    def unobserve(self, resource):
+        """Stop renewing the observation of the resource.
+
+        The running observation ends when its duration expires.
+        """
+        with self._condition:
+            self._watches.pop(_path(resource), None)
+
+    def health(self):
+        """Return the health of every observation by resource path."""
+        with self._condition:
+            return {key: watch.health() for key, watch in self._watches.items()}
+
+    def close(self):
+        """Stop renewing observations."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._executor.shutdown(wait=False)
+
+    def _schedule(self, key, watch, due):
+        """Queue a (re)subscription of the watch at monotonic time due."""
+        watch.due = due
+        self._sequence += 1
+        heapq.heappush(self._queue, (due, self._sequence, key))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    if not self._queue:
+                        self._condition.wait()
+                        continue
+                    due, _, key = self._queue[0]
+                    now = monotonic()
+                    if self._last_dispatch is not None:
+                        # Subscriptions are sent at least `stagger` apart.
+                        due = max(due, self._last_dispatch + self._stagger)
+                    if due > now:
+                        self._condition.wait(due - now)
+                        continue
+                    due = self._queue[0][0]
+                    heapq.heappop(self._queue)
+                    watch = self._watches.get(key)
+                    if watch is not None and watch.due == due:
+                        # Otherwise it was unobserved or rescheduled.
+                        break
+
+                watch.generation += 1
+                generation = watch.generation
+                self._last_dispatch = now
+
+            self._executor.submit(self._subscribe, key, watch, generation)
+
+    def _subscribe(self, key, watch, generation):
+        def callback(resource):
+            with self._condition:
+                current = (
+                    watch.generation == generation
+                    and resource is watch.resource
+                    and self._watches.get(key) is watch
+                )
+                if current:
+                    watch.last_update = time()
+                    watch.updates += 1
+            if not current:
+                # Superseded by a renewal or by observing another object of
+                # the resource, its updates would be stale.
+                raise StopObserving()
+            watch.callback(resource)
+
+        def err_callback(err):
+            self._failed(key, watch, generation, err)
+
+        _LOGGER.debug("Subscribing to %s", key)
+        try:
+            self._request(
+                watch.resource.observe(callback, err_callback, duration=self._duration)
+            )
+        except Exception as err:  # pylint: disable=broad-except
+            self._failed(key, watch, generation, err)
+            return
+
+        with self._condition:
+            if watch.generation != generation or self._watches.get(key) is not watch:
+                return
+            watch.state = STATE_ACTIVE
+            watch.subscribed_at = time()
+            watch.subscriptions += 1
+            watch.failures = 0
+            renew_in = self._duration - self._renew_margin * random.uniform(1, 1.5)
+            self._schedule(key, watch, monotonic() + max(0, renew_in))
+
+    def _failed(self, key, watch, generation, err):
+        with self._condition:
+            if (
+                self._closed
+                or watch.generation != generation
+                or self._watches.get(key) is not watch
+            ):
+                # A renewed observation took over, the old one expiring is fine.
+                return
+            watch.state = STATE_RETRYING
+            watch.failures += 1
+            watch.last_error = err
+            delay = min(
+                self._max_retry_delay, self._retry_delay * 2 ** (watch.failures - 1)
+            )
+            delay = random.uniform(delay / 2, delay)
+            _LOGGER.info("Resubscribing to %s in %.1fs: %s", key, delay, err)
+            # Invalidate the failed subscription, so its late errors are ignored.
+            watch.generation += 1
+            self._schedule(key, watch, monotonic() + delay)
+
+
+def _path(resource):
+    return "/".join(str(part) for part in resource.path)
@@ -2,13 +2,34 @@
 #  https://github.com/home-assistant/home-assistant/blob/4e8723f345d526ffbcbea74444e1a140a7eec863/homeassistant/util/json.py
 
 import logging
-from typing import Union, List, Dict
+import os
+import tempfile
+from typing import Union, List, Dict, Optional
 from .error import PytradfriError
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 _LOGGER = logging.getLogger(__name__)
 
 
+def loads(data: Union[str, bytes]) -> Union[List, Dict]:
+    """Parse JSON from str or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(data: Union[List, Dict]) -> bytes:
+    """Encode data as compact JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
 def load_json(filename: str) -> Union[List, Dict]:
     """Load JSON data from a file and return as dict or list.
 
@@ -29,22 +50,43 @@ def load_json(filename: str) -> Union[List, Dict]:
     return {}  # (also evaluates to False)
 
 
-def save_json(filename: str, config: Union[List, Dict]):
+def save_json(
+    filename: str, config: Union[List, Dict], *, indent: Optional[int] = 4
+):
     """Save JSON data to a file.
 
+    The data is written to a temporary file that replaces the file once it
+    is complete, so a crash never leaves a truncated file behind.
+
     Returns True on success.
     """
+    tmp_filename = None
     try:
-        data = json.dumps(config, sort_keys=True, indent=4)
-        with open(filename, "w", encoding="utf-8") as fdesc:
+        data = json.dumps(config, sort_keys=True, indent=indent)
+        fdesc, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)),
+            prefix=os.path.basename(filename) + ".",
+            suffix=".tmp",
+        )
+        with open(fdesc, "w", encoding="utf-8") as fdesc:
             fdesc.write(data)
-            return True
+            fdesc.flush()
+            os.fsync(fdesc.fileno())
+        if os.path.exists(filename):
+            # Keep the permissions of the file, e.g. of the psk config.
+            os.chmod(tmp_filename, os.stat(filename).st_mode)
+        os.replace(tmp_filename, filename)
+        tmp_filename = None
+        return True
     except TypeError as error:
         _LOGGER.exception("Failed to serialize to JSON: %s", filename)
         raise PytradfriError(error)
     except OSError as error:
         _LOGGER.exception("Saving JSON file failed: %s", filename)
         raise PytradfriError(error)
+    finally:
+        if tmp_filename is not None and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
 
 
 class BitChoices(object):
@@ -0,0 +1,58 @@
+"""Test the aiocoap API."""
+import asyncio
+
+import pytest
+
+from pytradfri.api.aiocoap_api import APIFactory
+from pytradfri.api.retry import LatencyTracker, RetryPolicy
+from pytradfri.command import Command
+from pytradfri.const import ROOT_DEVICES
+from pytradfri.error import RequestTimeout
+
+
+class MockRequest:
+    """Request the gateway never answers."""
+
+    def __init__(self):
+        self.response = asyncio.get_running_loop().create_future()
+
+
+class MockProtocol:
+    """Protocol recording its requests."""
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, msg):
+        request = MockRequest()
+        self.requests.append(request)
+        return request
+
+
+async def create_protocol(protocol):
+    return protocol
+
+
+def test_timed_out_attempts_are_cancelled():
+    """Test that an attempt that timed out doesn't keep running."""
+
+    async def run():
+        policy = RetryPolicy(
+            base_delay=0,
+            latency=LatencyTracker(initial_timeout=0.1, min_timeout=0.1),
+        )
+        api = await APIFactory.init("127.0.0.1", retry_policy=policy)
+        protocol = MockProtocol()
+        api._protocol = asyncio.ensure_future(create_protocol(protocol))
+
+        with pytest.raises(RequestTimeout):
+            await api.request(Command("get", [ROOT_DEVICES, 65536]), timeout=1)
+        await asyncio.sleep(0)
+
+        assert len(protocol.requests) == 3
+        # Every attempt stopped retransmitting once it timed out.
+        assert all(request.response.cancelled() for request in protocol.requests)
+        # The protocol shared by all requests wasn't cancelled with them.
+        assert not api._protocol.cancelled()
+
+    asyncio.run(run())
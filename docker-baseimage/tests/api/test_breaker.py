@@ -0,0 +1,69 @@
+"""Test the circuit breakers."""
+import pytest
+
+from pytradfri.api.breaker import (
+    STATE_CLOSED,
+    STATE_HALF_OPEN,
+    STATE_OPEN,
+    CircuitBreakers,
+)
+from pytradfri.command import Command
+from pytradfri.const import ROOT_DEVICES, ROOT_GROUPS
+from pytradfri.error import CircuitOpenError, RequestTimeout
+
+DEVICE_COMMAND = Command("get", [ROOT_DEVICES, 65536])
+GROUP_COMMAND = Command("get", [ROOT_GROUPS, 131073])
+
+
+def trip_gateway(breakers):
+    """Fail group commands until the gateway circuit opens."""
+    for _ in range(2):
+        breakers.before(GROUP_COMMAND)
+        breakers.after(GROUP_COMMAND, RequestTimeout())
+
+
+def test_gateway_opens_after_failures():
+    """Test the gateway circuit opening after consecutive failures."""
+    breakers = CircuitBreakers("host", gateway_failure_threshold=2)
+    trip_gateway(breakers)
+
+    assert breakers.gateway.state == STATE_OPEN
+    with pytest.raises(CircuitOpenError):
+        breakers.before(GROUP_COMMAND)
+
+
+def test_device_failure_does_not_open_gateway():
+    """Test one unanswered device not opening the gateway circuit."""
+    breakers = CircuitBreakers("host", failure_threshold=1)
+    breakers.before(DEVICE_COMMAND)
+    breakers.after(DEVICE_COMMAND, RequestTimeout())
+
+    assert breakers.device(65536).state == STATE_OPEN
+    assert breakers.gateway.state == STATE_CLOSED
+
+
+def test_failed_device_probe_reopens_gateway():
+    """Test a failed device command probing the gateway reopening it."""
+    breakers = CircuitBreakers("host", gateway_failure_threshold=2, reset_timeout=0)
+    trip_gateway(breakers)
+
+    breakers.before(DEVICE_COMMAND)
+    assert breakers.gateway.state == STATE_HALF_OPEN
+    breakers.after(DEVICE_COMMAND, RequestTimeout())
+
+    # The next command probes the gateway instead of failing fast for good.
+    breakers.before(GROUP_COMMAND)
+    breakers.after(GROUP_COMMAND)
+    assert breakers.gateway.state == STATE_CLOSED
+
+
+def test_successful_device_probe_closes_gateway():
+    """Test a device command probing the gateway closing it."""
+    breakers = CircuitBreakers("host", gateway_failure_threshold=2, reset_timeout=0)
+    trip_gateway(breakers)
+
+    breakers.before(DEVICE_COMMAND)
+    breakers.after(DEVICE_COMMAND)
+
+    assert breakers.gateway.state == STATE_CLOSED
+    assert breakers.device(65536).state == STATE_CLOSED
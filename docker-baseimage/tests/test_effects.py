@@ -0,0 +1,34 @@
+"""Test the effect engine."""
+import asyncio
+
+from pytradfri.device import Device
+from pytradfri.effects import EffectEngine, Timeline
+
+LIGHT = {
+    "9003": 65536,
+    "9001": "Bulb",
+    "5750": 2,
+    "9019": 1,
+    "3": {"0": "IKEA of Sweden", "1": "TRADFRI bulb E27 WS opal 980lm", "3": "2.3.050"},
+    "3311": [{"5850": 1, "5851": 100, "5711": 300, "9003": 0}],
+}
+
+
+def test_frame_of_two_commands_is_sent():
+    """Test sending dimmer and mireds separately within the rate."""
+    light = Device(LIGHT)
+    assert not light.light_control.can_combine_commands
+    sent = []
+
+    async def request(command):
+        sent.append(command)
+
+    async def run():
+        engine = EffectEngine(request, rate=10)
+        timeline = Timeline().set([light], 0, dimmer=200, color_temp=350)
+        return await asyncio.wait_for(engine.run(timeline), 1)
+
+    effect = asyncio.run(run())
+
+    assert len(sent) == 2
+    assert effect.sent == 2